@@ -0,0 +1,421 @@
+# coding: utf-8
+#
+# Local stand-ins of WDA, WDA MJPEG server, usbmuxd and atxserver2 heartbeat
+#
+# Used by benchmarks, every fake listens on 127.0.0.1 (or a unix socket)
+# and needs no device. Also runnable as a fake xcodebuild, which starts a
+# FakeWDA on the USE_PORT given by the simulator launch command:
+#
+#   python benchmarks/fakes.py xcodebuild ... USE_PORT=8100 MJPEG_SERVER_PORT=9100 test
+
+import base64
+import itertools
+import json
+import multiprocessing
+import os
+import plistlib
+import socket
+import struct
+import sys
+import time
+import uuid
+
+import tornado.web
+from tornado import gen
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.netutil import bind_sockets, bind_unix_socket
+from tornado.tcpserver import TCPServer
+from tornado.websocket import WebSocketHandler
+
+PNG_HEADER = b"\x89PNG\r\n\x1a\n"
+
+
+def free_port() -> int:
+    sock, = bind_sockets(0, "127.0.0.1")
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _serve(fake, port: int):
+    fake.listen(port)
+    IOLoop.current().start()
+
+
+def start_process(fake, port: int = None) -> tuple:
+    """
+    Run fake server in a child process, so it does not share the IOLoop being measured
+
+    Returns:
+        (port, multiprocessing.Process)
+    """
+    port = port or free_port()
+    p = multiprocessing.Process(target=_serve, args=(fake, port), daemon=True)
+    p.start()
+    return port, p
+
+
+async def wait_port(port: int, timeout: float = 10):
+    deadline = time.time() + timeout
+    while True:
+        stream = IOStream(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+        try:
+            await stream.connect(("127.0.0.1", port))
+            return
+        except (OSError, StreamClosedError):
+            if time.time() > deadline:
+                raise RuntimeError("wait port timeout", port)
+            await gen.sleep(.05)
+        finally:
+            stream.close()
+
+
+class _WDAHandler(tornado.web.RequestHandler):
+    def initialize(self, wda):
+        self.wda = wda
+
+    async def prepare(self):
+        self.wda.requests += 1
+        if self.wda.latency:
+            await gen.sleep(self.wda.latency)
+
+    def reply(self, value, session_id=None):
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps({"value": value, "sessionId": session_id}))
+
+
+class _StatusHandler(_WDAHandler):
+    def get(self):
+        self.reply({"ready": True, "ios": {"ip": self.wda.ip}, "state": "success"})
+
+
+class _ScreenshotHandler(_WDAHandler):
+    def get(self):
+        self.reply(self.wda.screenshot)
+
+
+class _SourceHandler(_WDAHandler):
+    def get(self):
+        self.reply(self.wda.source)
+
+
+class _SessionHandler(_WDAHandler):
+    async def post(self):
+        if self.wda.session_delay:
+            await gen.sleep(self.wda.session_delay)
+        session_id = str(uuid.uuid4()).upper()
+        self.wda.sessions = {session_id}  # like WDA, previous session is killed
+        self.wda.sessions_created += 1
+        self.reply({"sessionId": session_id, "capabilities": {}}, session_id)
+
+
+class _SessionCommandHandler(_WDAHandler):
+    def get(self, session_id, path):
+        if not path and session_id not in self.wda.sessions:
+            self.set_status(404)
+            self.reply({"error": "invalid session id", "message": "Session does not exist"},
+                       session_id)
+            return
+        self.reply(None, session_id)
+
+    def post(self, session_id, path):
+        if path.startswith("/element"):
+            self.reply({"ELEMENT": "1"}, session_id)
+        else:
+            self.reply(None, session_id)
+
+    def delete(self, session_id, path):
+        if not path:
+            self.wda.sessions.discard(session_id)
+        self.reply(None, session_id)
+
+
+class _HealthcheckHandler(_WDAHandler):
+    def get(self):
+        self.reply(None)
+
+
+class _SettingsHandler(_WDAHandler):
+    def get(self, session_id=None):
+        self.reply(self.wda.settings, session_id)
+
+    def post(self, session_id=None):
+        settings = json.loads(self.request.body or b"{}").get("settings", {})
+        self.wda.update_settings(settings)
+        self.reply(self.wda.settings, session_id)
+
+
+class FakeWDA(object):
+    """
+    WebDriverAgent HTTP server, every request is delayed by latency seconds
+
+    - GET /status
+    - GET /screenshot: base64 of a screenshot_size bytes PNG
+    - GET /source: payload_size bytes of XML
+    - POST /session: takes session_delay seconds, only the latest session is alive
+    - GET /session/<id>: 404 when the session is gone
+    - DELETE /session/<id>, and any other /session/<id>/... command
+    - GET /wda/healthcheck
+    - GET, POST /appium/settings: mjpeg settings are passed to mjpeg server if given
+    """
+
+    def __init__(self,
+                 latency: float = 0.0,
+                 payload_size: int = 4 << 10,
+                 screenshot_size: int = 200 << 10,
+                 ip: str = "127.0.0.1",
+                 mjpeg=None,
+                 session_delay: float = 0.0):
+        """
+        Args:
+            mjpeg: FakeMjpegServer running in the same process
+        """
+        self.latency = latency
+        self.ip = ip
+        self.mjpeg = mjpeg
+        self.requests = 0
+        self.sessions = set()
+        self.sessions_created = 0
+        self.session_delay = session_delay
+        self.settings = {
+            "mjpegServerFramerate": mjpeg.fps if mjpeg else 10,
+            "mjpegScalingFactor": 100,
+            "mjpegServerScreenshotQuality": 25,
+        }
+        self.screenshot = base64.b64encode(
+            PNG_HEADER + os.urandom(max(0, screenshot_size - len(PNG_HEADER)))).decode('ascii')
+        self.source = "<XCUIElementTypeApplication>" + "x" * payload_size + \
+            "</XCUIElementTypeApplication>"
+
+    def update_settings(self, settings: dict):
+        self.settings.update(settings)
+        if self.mjpeg:
+            self.mjpeg.configure(fps=self.settings['mjpegServerFramerate'],
+                                 scale=self.settings['mjpegScalingFactor'])
+
+    def make_app(self) -> tornado.web.Application:
+        kwargs = dict(wda=self)
+        return tornado.web.Application([
+            (r"/status", _StatusHandler, kwargs),
+            (r"(?:/session/[^/]+)?/screenshot/?", _ScreenshotHandler, kwargs),
+            (r"(?:/session/[^/]+)?/source/?", _SourceHandler, kwargs),
+            (r"/wda/healthcheck", _HealthcheckHandler, kwargs),
+            (r"(?:/session/([^/]+))?/appium/settings", _SettingsHandler, kwargs),
+            (r"/session", _SessionHandler, kwargs),
+            (r"/session/([^/]+)(/.*)?", _SessionCommandHandler, kwargs),
+        ])
+
+    def listen(self, port: int = 0) -> int:
+        sockets = bind_sockets(port, "127.0.0.1")
+        server = HTTPServer(self.make_app())
+        server.add_sockets(sockets)
+        return sockets[0].getsockname()[1]
+
+
+class FakeMjpegServer(TCPServer):
+    """
+    multipart/x-mixed-replace stream like WDA mjpegServer
+
+    Frames are random bytes between JPEG SOI and EOI markers, their size is
+    width*height/compression scaled by scale percent in both dimensions.
+    Every connection gets frames at fps, a slow reader lowers its own rate.
+    """
+
+    def __init__(self, fps: float = 10, width: int = 750, height: int = 1334,
+                 compression: int = 20, scale: int = 100):
+        super().__init__()
+        self.width = width
+        self.height = height
+        self.compression = compression
+        self.connections = 0
+        self.frames_sent = 0
+        self.configure(fps, scale)
+
+    def configure(self, fps: float = None, scale: int = None):
+        if fps is not None:
+            self.fps = fps
+        if scale is not None:
+            self.scale = scale
+        size = int(self.width * self.height * (self.scale / 100)**2 / self.compression)
+        # a few different frames, so nothing is compressed or deduplicated by accident
+        self._frames = [self._part(max(16, size)) for _ in range(4)]
+
+    def _part(self, size: int) -> bytes:
+        body = b"\xff\xd8" + os.urandom(size - 4) + b"\xff\xd9"
+        return (b"--BoundaryString\r\n"
+                b"Content-type: image/jpg\r\n"
+                b"Content-Length: %d\r\n\r\n" % len(body)) + body + b"\r\n\r\n"
+
+    def listen(self, port: int = 0) -> int:
+        sockets = bind_sockets(port, "127.0.0.1")
+        self.add_sockets(sockets)
+        return sockets[0].getsockname()[1]
+
+    async def handle_stream(self, stream: IOStream, address):
+        self.connections += 1
+        try:
+            await stream.read_until(b"\r\n\r\n")
+            await stream.write(b"HTTP/1.0 200 OK\r\n"
+                               b"Content-Type: multipart/x-mixed-replace; boundary=--BoundaryString\r\n"
+                               b"\r\n")
+            next_time = IOLoop.current().time()
+            for i in itertools.count():
+                await stream.write(self._frames[i % len(self._frames)])
+                self.frames_sent += 1
+                next_time = max(next_time + 1.0 / self.fps, IOLoop.current().time() - 1.0)
+                await gen.sleep(max(0, next_time - IOLoop.current().time()))
+        except StreamClosedError:
+            pass
+        finally:
+            self.connections -= 1
+
+
+class FakeUsbmuxd(TCPServer):
+    """
+    usbmuxd unix socket, supports ListDevices and Listen
+
+    Devices are plugged by attach(udid) and unplugged by detach(udid),
+    Listen clients receive Attached for present devices, then live events.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._device_ids = itertools.count(1)
+        self.devices = {}  # udid -> DeviceID
+        self._listeners = set()
+
+    def listen(self, path: str) -> str:
+        self.add_socket(bind_unix_socket(path))
+        return path
+
+    def _properties(self, udid: str) -> dict:
+        return {
+            "ConnectionType": "USB",
+            "DeviceID": self.devices[udid],
+            "SerialNumber": udid,
+            "UDID": udid,
+            "ProductID": 4776,
+            "LocationID": 0,
+        }
+
+    def _attached(self, udid: str) -> dict:
+        return {
+            "MessageType": "Attached",
+            "DeviceID": self.devices[udid],
+            "Properties": self._properties(udid),
+        }
+
+    def attach(self, udid: str):
+        self.devices[udid] = next(self._device_ids)
+        self._broadcast(self._attached(udid))
+
+    def detach(self, udid: str):
+        device_id = self.devices.pop(udid)
+        self._broadcast({"MessageType": "Detached", "DeviceID": device_id})
+
+    def _broadcast(self, payload: dict):
+        for stream in list(self._listeners):
+            IOLoop.current().spawn_callback(self._send, stream, payload)
+
+    async def _send(self, stream: IOStream, payload: dict, tag: int = 0):
+        body = plistlib.dumps(payload)
+        try:
+            await stream.write(struct.pack("<IIII", 16 + len(body), 1, 8, tag) + body)
+        except StreamClosedError:
+            self._listeners.discard(stream)
+
+    async def handle_stream(self, stream: IOStream, address):
+        try:
+            while True:
+                header = await stream.read_bytes(16)
+                length, _, _, tag = struct.unpack("<IIII", header)
+                request = plistlib.loads(await stream.read_bytes(length - 16))
+                message_type = request.get("MessageType")
+                if message_type == "ListDevices":
+                    await self._send(stream, {
+                        "DeviceList": [self._attached(udid) for udid in self.devices]
+                    }, tag)
+                elif message_type == "Listen":
+                    await self._send(stream, {"MessageType": "Result", "Number": 0}, tag)
+                    for udid in list(self.devices):
+                        await self._send(stream, self._attached(udid))
+                    self._listeners.add(stream)
+                else:
+                    await self._send(stream, {"MessageType": "Result", "Number": 1}, tag)
+        except StreamClosedError:
+            self._listeners.discard(stream)
+
+
+class _HeartbeatHandler(WebSocketHandler):
+    def initialize(self, server):
+        self.server = server
+
+    def on_message(self, message):
+        server = self.server
+        data = json.loads(message)
+        server.messages += 1
+        server.last_message_time = time.time()
+        command = data.get("command")
+        if command == "handshake":
+            server.handshakes.append(data)
+            self.write_message({"success": True, "id": str(uuid.uuid4())})
+        elif command == "update":
+            server.updates += 1
+            server.devices.setdefault(data['udid'], {}).update(data)
+
+
+class FakeHeartbeatServer(object):
+    """
+    atxserver2 /websocket/heartbeat, records what providers send
+
+    - handshakes: handshake messages
+    - devices: udid -> merged update messages
+    - messages, updates: message counts
+    """
+
+    def __init__(self):
+        self.handshakes = []
+        self.devices = {}
+        self.messages = 0
+        self.updates = 0
+        self.last_message_time = 0.0
+
+    def listen(self, port: int = 0) -> int:
+        app = tornado.web.Application([
+            (r"/websocket/heartbeat", _HeartbeatHandler, dict(server=self)),
+        ])
+        sockets = bind_sockets(port, "127.0.0.1")
+        server = HTTPServer(app)
+        server.add_sockets(sockets)
+        return sockets[0].getsockname()[1]
+
+
+def fake_xcodebuild(args: list):
+    """
+    Print what xcodebuild prints when WebDriverAgentRunner starts, then serve FakeWDA
+    and FakeMjpegServer on USE_PORT and MJPEG_SERVER_PORT
+
+    Environment:
+        FAKE_WDA_BOOT: seconds between test started and WDA listening, default 1
+        FAKE_WDA_SESSION: seconds to create a session, default 0
+    """
+    env = dict(arg.split("=", 1) for arg in args if "=" in arg and not arg.startswith("-"))
+    boot = float(os.environ.get("FAKE_WDA_BOOT", "1"))
+    print("Test Suite 'All tests' started at", time.strftime("%Y-%m-%d %H:%M:%S"), flush=True)
+    time.sleep(boot)
+    mjpeg = FakeMjpegServer()
+    if env.get("MJPEG_SERVER_PORT"):
+        mjpeg.listen(int(env['MJPEG_SERVER_PORT']))
+    session_delay = float(os.environ.get("FAKE_WDA_SESSION", "0"))
+    port = FakeWDA(mjpeg=mjpeg, session_delay=session_delay).listen(int(env.get("USE_PORT", 8100)))
+    print("ServerURLHere->http://127.0.0.1:{}<-ServerURLHere".format(port), flush=True)
+    IOLoop.current().start()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["xcodebuild"]:
+        fake_xcodebuild(sys.argv[2:])
+    else:
+        sys.exit("Usage: {} xcodebuild [args...]".format(sys.argv[0]))
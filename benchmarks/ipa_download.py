@@ -0,0 +1,125 @@
+# coding: utf-8
+#
+# Benchmark ipa download against a local HTTP server with Range support
+#
+# Every connection is throttled to --rate bytes/s like a CDN edge, compare
+# a single stream with parallel range segments. With --drops N, the first N
+# connections are closed in the middle to exercise resuming.
+#
+# Usage:
+#   python benchmarks/ipa_download.py --size 64 --rate 20
+#   python benchmarks/ipa_download.py --size 64 --rate 20 --drops 2
+
+import argparse
+import hashlib
+import http.server
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from downloader import RangeDownloader  # noqa: E402
+
+RANGE_RE = re.compile(r"bytes=(\d+)-(\d*)")
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    data = b""
+    etag = '"0"'
+    rate = 0  # bytes per second of every connection, 0 means unlimited
+    drops = 0  # close this many connections in the middle
+    _lock = threading.Lock()
+
+    def do_GET(self):
+        start, end = 0, len(self.data) - 1
+        m = RANGE_RE.match(self.headers.get("Range", ""))
+        if m and self.headers.get("If-Range", self.etag) == self.etag:
+            start = int(m.group(1))
+            end = int(m.group(2) or end)
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, len(self.data)))
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", self.etag)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+
+        with self._lock:
+            drop = RangeHandler.drops > 0
+            RangeHandler.drops -= drop
+        stop = (start + end) // 2 if drop else end + 1
+        chunk_size = 1 << 16
+        begin = time.perf_counter()
+        sent = 0
+        try:
+            for offset in range(start, stop, chunk_size):
+                self.wfile.write(self.data[offset:min(offset + chunk_size, stop)])
+                sent += chunk_size
+                if self.rate:
+                    delay = sent / self.rate - (time.perf_counter() - begin)
+                    if delay > 0:
+                        time.sleep(delay)
+        except (BrokenPipeError, ConnectionResetError):  # client got enough
+            self.close_connection = True
+            return
+        if drop:
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+def run(url: str, segments: int, expect_sha256: str) -> dict:
+    workdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(workdir, "app.ipa")
+        downloader = RangeDownloader(segments=segments, min_segment_size=1 << 20)
+        try:
+            stats = downloader.download(url, path)
+        except IOError as e:
+            # resumed by the next download() like IPACache does
+            print("interrupted: {}, download again".format(e), file=sys.stderr)
+            stats = downloader.download(url, path)
+        with open(path, "rb") as f:
+            stats["sha256Ok"] = hashlib.sha256(f.read()).hexdigest() == expect_sha256
+        stats["megabytesPerSecond"] = round(stats.pop("bytesPerSecond") / 1e6, 1)
+        return stats
+    finally:
+        shutil.rmtree(workdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--size", type=int, default=64, help="ipa size in MB")
+    parser.add_argument("--rate", type=float, default=20, help="MB/s of every connection, 0 for unlimited")
+    parser.add_argument("--segments", type=int, default=4, help="parallel segments")
+    parser.add_argument("--drops", type=int, default=0, help="connections closed in the middle")
+    args = parser.parse_args()
+
+    RangeHandler.data = os.urandom(args.size << 20)
+    RangeHandler.rate = int(args.rate * 1e6)
+    expect = hashlib.sha256(RangeHandler.data).hexdigest()
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}/app.ipa".format(server.server_port)
+    try:
+        results = {}
+        for name, segments in (("single", 1), ("segmented", args.segments)):
+            RangeHandler.drops = args.drops
+            results[name] = run(url, segments, expect)
+    finally:
+        server.shutdown()
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
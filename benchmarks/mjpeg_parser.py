@@ -0,0 +1,182 @@
+# coding: utf-8
+#
+# Micro benchmark of MJPEG reading
+#
+# Replay a recorded multipart stream from a local TCP server, and compare
+# MjpegReader with the old line by line read_until implementation.
+#
+# Usage:
+#   python benchmarks/mjpeg_parser.py                       # synthetic stream
+#   python benchmarks/mjpeg_parser.py --record http://localhost:9100 -o stream.bin
+#   python benchmarks/mjpeg_parser.py -i stream.bin --frames 3000
+#
+# alloc_bytes_per_frame needs python >= 3.9 (tracemalloc.reset_peak), it is
+# null on older versions
+
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+import tracemalloc
+import urllib.request
+
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.netutil import bind_sockets
+from tornado.tcpserver import TCPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mjpeg import MjpegReader  # noqa: E402
+
+HTTP_HEADER = (b"HTTP/1.0 200 OK\r\n"
+               b"Content-Type: multipart/x-mixed-replace; boundary=--BoundaryString\r\n"
+               b"\r\n")
+
+
+def synthetic_stream(frames: int = 100, frame_size: int = 60000) -> bytes:
+    parts = []
+    for i in range(frames):
+        body = b"\xff\xd8" + os.urandom(frame_size - 4) + b"\xff\xd9"
+        parts.append(b"--BoundaryString\r\n"
+                     b"Content-type: image/jpg\r\n"
+                     b"Content-Length: %d\r\n\r\n" % len(body))
+        parts.append(body)
+        parts.append(b"\r\n\r\n")
+    return b"".join(parts)
+
+
+def record(url: str, seconds: float) -> bytes:
+    """ record multipart body (without http header) from a running mjpeg server """
+    data = bytearray()
+    deadline = time.time() + seconds
+    with urllib.request.urlopen(url) as f:
+        while time.time() < deadline:
+            data.extend(f.read1(65536))
+    return bytes(data)
+
+
+class ReplayServer(TCPServer):
+    def __init__(self, data: bytes):
+        super().__init__()
+        self._data = data
+
+    async def handle_stream(self, stream: IOStream, address):
+        try:
+            await stream.read_until(b"\r\n\r\n")
+            await stream.write(HTTP_HEADER)
+            while True:
+                await stream.write(self._data)
+        except StreamClosedError:
+            pass
+
+
+class LegacyMjpegReader(MjpegReader):
+    """ the read_until(b'\\r\\n') implementation MjpegParser replaced """
+    async def aiter_content(self):
+        stream = IOStream(socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0))
+        try:
+            url = urllib.request.urlparse(self._url)
+            host, port = url.netloc.split(":")
+            await stream.connect((host, int(port)))
+            await stream.write(b"GET / HTTP/1.0\r\n\r\n")
+            await stream.read_until(b"\r\n\r\n")
+            while True:
+                line = await stream.read_until(b'\r\n')
+                if not line.startswith(b"Content-Length"):
+                    continue
+                length = int(line.decode('utf-8').split(": ")[1])
+                await stream.read_until(b"\r\n")
+                yield await stream.read_bytes(length)
+        finally:
+            stream.close()
+
+
+async def run_reader(reader: MjpegReader, frames: int, trace: bool) -> dict:
+    """
+    With trace, allocations of every frame are measured as the tracemalloc peak
+    above the memory in use when the previous frame was received, the peak is
+    reset per frame. Allocations done once (eg: receive buffer) are not counted,
+    the first frame (connect and buffer setup) is skipped.
+    """
+    if trace:
+        tracemalloc.start()
+    count = nbytes = 0
+    frame_allocs = []
+    start = time.perf_counter()
+    async for content in reader.aiter_content():
+        count += 1
+        nbytes += len(content)
+        if trace:
+            _, peak = tracemalloc.get_traced_memory()
+            if count > 1:
+                frame_allocs.append(peak - base)
+            del content  # do not count the frame we hold
+            base, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+        if count >= frames:
+            break
+    elapsed = time.perf_counter() - start
+    result = {"frames": count, "seconds": round(elapsed, 4)}
+    if trace:
+        tracemalloc.stop()
+        result["alloc_bytes_per_frame"] = int(sum(frame_allocs) / len(frame_allocs)) \
+            if frame_allocs else 0
+    else:
+        result["frames_per_second"] = round(count / elapsed, 1)
+        result["megabytes_per_second"] = round(nbytes / elapsed / 1e6, 1)
+    return result
+
+
+async def benchmark(data: bytes, frames: int) -> dict:
+    server = ReplayServer(data)
+    sock, = bind_sockets(0, "127.0.0.1")
+    server.add_sockets([sock])
+    url = "http://127.0.0.1:{}".format(sock.getsockname()[1])
+    results = {}
+    try:
+        for name, reader_class in (("legacy", LegacyMjpegReader),
+                                   ("parser", MjpegReader)):
+            result = await run_reader(reader_class(url), frames, trace=False)
+            result["alloc_bytes_per_frame"] = None
+            if hasattr(tracemalloc, "reset_peak"):
+                traced = await run_reader(reader_class(url), max(2, frames // 10), trace=True)
+                result["alloc_bytes_per_frame"] = traced["alloc_bytes_per_frame"]
+            results[name] = result
+    finally:
+        server.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-i", "--input", help="recorded multipart stream file")
+    parser.add_argument("--record", help="mjpeg url to record from, eg: http://localhost:9100")
+    parser.add_argument("--seconds", type=float, default=10, help="record duration")
+    parser.add_argument("-o", "--output", default="mjpeg-stream.bin", help="record output file")
+    parser.add_argument("--frames", type=int, default=2000, help="frames to read in each run")
+    parser.add_argument("--frame-size", type=int, default=60000, help="synthetic frame size")
+    args = parser.parse_args()
+
+    if args.record:
+        data = record(args.record, args.seconds)
+        with open(args.output, "wb") as f:
+            f.write(data)
+        print("recorded {} bytes to {}".format(len(data), args.output))
+        return
+
+    if args.input:
+        with open(args.input, "rb") as f:
+            data = f.read()
+    else:
+        data = synthetic_stream(frame_size=args.frame_size)
+
+    results = IOLoop.current().run_sync(lambda: benchmark(data, args.frames))
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
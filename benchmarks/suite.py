@@ -0,0 +1,563 @@
+# coding: utf-8
+#
+# Offline benchmark suite, runs against the local fakes in fakes.py
+#
+# Scenarios:
+#   proxy      requests/s through wdaproxy-script.py to a FakeWDA
+#   mjpeg      frames/s of N /screen viewers through wdaproxy-script.py
+#   heartbeat  device updates/s from HeartbeatConnection to a FakeHeartbeatServer
+#   plug       usbmuxd Attached to WDA ready latency of N devices, launched
+#              by WDADevice with a fake xcodebuild (simulator mode)
+#   cold       public wdaproxy port change and health check of a ready device
+#   screen     /screen frames/s and bytes/s of viewers asking for a lower fps
+#              and scale, alone and together with a full rate viewer
+#   session    POST /session latency of test jobs in a row on a ready device,
+#              with or without a pre-created session (--no-session-pool)
+#
+# Results are printed as JSON, use -o to save them and --compare to print the
+# change against a previous run.
+#
+# Usage:
+#   python benchmarks/suite.py                                # all scenarios
+#   python benchmarks/suite.py proxy mjpeg --viewers 8 -o after.json
+#   python benchmarks/suite.py --compare before.json -o after.json
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+from tornado import gen, websocket
+from tornado.ioloop import IOLoop
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fakes import (FakeHeartbeatServer, FakeMjpegServer, FakeUsbmuxd,  # noqa: E402
+                   FakeWDA, free_port, start_process, wait_port)
+
+SCENARIOS = ("proxy", "mjpeg", "heartbeat", "plug", "cold", "session", "screen")
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def start_proxy(wda_url: str, mjpeg_url: str = "http://127.0.0.1:9100",
+                extra_args: list = ()) -> tuple:
+    """
+    Returns:
+        (port, subprocess.Popen)
+    """
+    port = free_port()
+    p = subprocess.Popen([
+        sys.executable, os.path.join(ROOT, "wdaproxy-script.py"), "-p", str(port),
+        "--wda-url", wda_url, "--mjpeg-url", mjpeg_url] + list(extra_args),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=ROOT)  # yapf: disable
+    return port, p
+
+
+def stop(p):
+    """ stop multiprocessing.Process or subprocess.Popen """
+    p.terminate()
+    if isinstance(p, subprocess.Popen):
+        p.wait()
+    else:
+        p.join()
+
+
+async def proxy_load(url: str, total: int, concurrency: int) -> dict:
+    """ half GET /status and half POST element, like a test script """
+    todo = list(range(total))
+    latencies = []
+
+    async def worker(client: httpx.AsyncClient):
+        while todo:
+            i = todo.pop()
+            start = time.perf_counter()
+            if i % 2:
+                r = await client.get(url + "/status")
+            else:
+                r = await client.post(url + "/session/abc/element",
+                                      json={"using": "id", "value": "login"})
+            r.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+    return {
+        "requests": total,
+        "requests_per_second": round(total / elapsed, 1),
+        "p50_ms": round(percentile(latencies, .5) * 1000, 2),
+        "p99_ms": round(percentile(latencies, .99) * 1000, 2),
+    }
+
+
+def bench_proxy(wda_port: int, total: int, concurrency: int, extra_args: list = ()) -> dict:
+    port, p = start_proxy("http://127.0.0.1:{}".format(wda_port), extra_args=extra_args)
+    try:
+        IOLoop.current().run_sync(lambda: wait_port(port))
+        return asyncio.run(proxy_load("http://127.0.0.1:{}".format(port), total, concurrency))
+    finally:
+        stop(p)
+
+
+def scenario_proxy(args) -> dict:
+    wda_port, wda = start_process(FakeWDA(latency=args.wda_latency,
+                                          payload_size=args.payload_size))
+    try:
+        IOLoop.current().run_sync(lambda: wait_port(wda_port))
+        result = bench_proxy(wda_port, args.requests, args.concurrency)
+    finally:
+        stop(wda)
+    result.update(concurrency=args.concurrency, wda_latency_ms=args.wda_latency * 1000)
+    return result
+
+
+async def _watch_screen(url: str, seconds: float, options: dict = None) -> tuple:
+    """
+    Args:
+        options: control message, frames of the first second are not counted
+
+    Returns:
+        (frames, bytes) received in seconds
+    """
+    ws = await websocket.websocket_connect(url, max_message_size=64 << 20)
+    if options:
+        await ws.write_message(json.dumps(options))
+        settle = IOLoop.current().time() + 1
+        while IOLoop.current().time() < settle:
+            await ws.read_message()
+    frames = nbytes = 0
+    deadline = IOLoop.current().time() + seconds
+    try:
+        while True:
+            try:
+                message = await gen.with_timeout(deadline, ws.read_message())
+            except gen.TimeoutError:
+                break
+            if message is None:
+                raise RuntimeError("/screen closed", url)
+            frames += 1
+            nbytes += len(message)
+    finally:
+        ws.close()
+    return frames, nbytes
+
+
+def scenario_mjpeg(args) -> dict:
+    width, height = map(int, args.resolution.split("x"))
+    mjpeg_port, mjpeg = start_process(FakeMjpegServer(fps=args.fps, width=width, height=height))
+    wda_port, wda = start_process(FakeWDA())
+    port, proxy = start_proxy("http://127.0.0.1:{}".format(wda_port),
+                              "http://127.0.0.1:{}".format(mjpeg_port))
+    url = "ws://127.0.0.1:{}/screen".format(port)
+
+    async def run():
+        await wait_port(mjpeg_port)
+        await wait_port(port)
+        await _watch_screen(url, .5)  # warm up
+        return await asyncio.gather(
+            *[_watch_screen(url, args.seconds) for _ in range(args.viewers)])
+
+    try:
+        results = IOLoop.current().run_sync(run)
+    finally:
+        for p in (proxy, wda, mjpeg):
+            stop(p)
+    rates = [frames / args.seconds for frames, _ in results]
+    return {
+        "viewers": args.viewers,
+        "upstream_fps": args.fps,
+        "resolution": args.resolution,
+        "frames_per_second_min": round(min(rates), 1),
+        "frames_per_second_avg": round(sum(rates) / len(rates), 1),
+        "total_frames_per_second": round(sum(rates), 1),
+        "megabytes_per_second": round(sum(n for _, n in results) / args.seconds / 1e6, 1),
+    }
+
+
+def scenario_heartbeat(args) -> dict:
+    from heartbeat import heartbeat_connect
+
+    server = FakeHeartbeatServer()
+
+    async def run():
+        port = server.listen(0)
+        hbc = await heartbeat_connect("http://127.0.0.1:{}".format(port),
+                                      self_url="http://127.0.0.1:3500",
+                                      platform="apple",
+                                      flush_interval=args.flush_interval)
+        udids = ["bench-{:04d}".format(i) for i in range(args.devices)]
+        latest = {}  # udid -> last sent wdaUrl
+        start = time.perf_counter()
+        for i in range(args.updates):
+            udid = udids[i % len(udids)]
+            latest[udid] = "http://127.0.0.1:{}".format(20000 + i)
+            await hbc.device_update({
+                "udid": udid,
+                "colding": False,
+                "provider": {"wdaUrl": latest[udid]},
+            })
+            if args.rate:
+                await gen.sleep(1.0 / args.rate)
+        queued = time.perf_counter() - start
+
+        def received(udid: str) -> str:
+            return server.devices.get(udid, {}).get("provider", {}).get("wdaUrl")
+
+        while any(received(udid) != url for udid, url in latest.items()):
+            await gen.sleep(.005)
+        elapsed = time.perf_counter() - start
+        return {
+            "updates": args.updates,
+            "devices": args.devices,
+            "flush_interval": args.flush_interval,
+            "updates_per_second": round(args.updates / queued, 1) if queued else None,
+            "messages_sent": server.updates,
+            "messages_saved": hbc.messages_saved,
+            "messages_per_second": round(server.updates / elapsed, 1),
+            "drain_seconds": round(elapsed - queued, 3),
+        }
+
+    return IOLoop.current().run_sync(run)
+
+
+class DeviceFarm(object):
+    """
+    Simulators plugged to FakeUsbmuxd, tracked and launched by Tracker and
+    WDADevice like main.py does, WDA is served by the fake xcodebuild.
+    """
+
+    def __init__(self, count: int, wda_boot: float, wdaproxy_mode: str = "gateway",
+                 session_delay: float = 0.0, gateway_options: dict = None):
+        """
+        Args:
+            session_delay: seconds fake wda takes to create a session
+            gateway_options: keyword arguments of WDAProxyGateway
+        """
+        import idb
+        import logzero
+
+        self.workdir = tempfile.mkdtemp()
+        bindir = os.path.join(self.workdir, "bin")
+        os.makedirs(bindir)
+        with open(os.path.join(bindir, "xcodebuild"), "w") as f:
+            f.write('#!/bin/sh\nexec "{}" "{}" xcodebuild "$@"\n'.format(
+                sys.executable, os.path.join(ROOT, "benchmarks", "fakes.py")))
+        os.chmod(os.path.join(bindir, "xcodebuild"), 0o755)
+        os.environ["PATH"] = bindir + os.pathsep + os.environ["PATH"]
+        os.environ["FAKE_WDA_BOOT"] = str(wda_boot)
+        os.environ["FAKE_WDA_SESSION"] = str(session_delay)
+
+        self.udids = ["BENCH-{:04d}-0000-0000-000000000000".format(i) for i in range(count)]
+        devices_path = os.path.join(self.workdir, "devices.json")
+        with open(devices_path, "w") as f:
+            json.dump({udid: {"DeviceName": "bench", "ProductType": "i386"}
+                       for udid in self.udids}, f)  # yapf: disable
+        idb.device_info_cache = idb.DeviceInfoCache(devices_path)  # no lockdown query
+        logzero.loglevel(logging.WARNING)
+
+        self.wdaproxy_mode = wdaproxy_mode
+        self.gateway_options = gateway_options or {}
+        self.usbmuxd_path = os.path.join(self.workdir, "usbmuxd")
+        self.usbmuxd = FakeUsbmuxd()
+        self.tracker = idb.Tracker(listen=True, usbmux_address=self.usbmuxd_path)
+        self.devices = {}  # udid -> WDADevice
+        self.plugged = {}  # udid -> time
+        self.ready = {}  # udid -> time
+        self._all_ready = asyncio.Event()
+
+    async def _callback(self, d, status: str, info=None):
+        if status == d.status_ready and d.udid not in self.ready:
+            self.ready[d.udid] = time.perf_counter()
+            if len(self.ready) == len(self.udids):
+                self._all_ready.set()
+
+    async def _track(self):
+        import idb
+        import wdaproxy
+        from scheduler import LaunchScheduler
+
+        gateway = None
+        if self.wdaproxy_mode == "gateway":
+            gateway = wdaproxy.WDAProxyGateway(**self.gateway_options)
+        scheduler = LaunchScheduler()
+        async for event in self.tracker.track_devices():
+            if event.udid not in self.udids:
+                continue  # eg: booted simulators of this mac
+            if event.present:
+                d = self.devices[event.udid] = idb.WDADevice(event.udid, scheduler,
+                                                             self._callback)
+                d.wda_directory = self.workdir
+                d.proxy_gateway = gateway
+                d.start()
+
+    async def plug_all(self, interval: float, timeout: float = 60):
+        """ plug devices one after another, wait until all of them are ready """
+        self.usbmuxd.listen(self.usbmuxd_path)
+        IOLoop.current().spawn_callback(self._track)
+        await gen.sleep(.5)  # listen connected
+        for udid in self.udids:
+            self.plugged[udid] = time.perf_counter()
+            self.usbmuxd.attach(udid)
+            await gen.sleep(interval)
+        await asyncio.wait_for(self._all_ready.wait(), timeout)
+
+    async def stop(self):
+        self.tracker.stop()
+        await asyncio.gather(*[d.stop() for d in self.devices.values()])
+
+    def cleanup(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def scenario_plug(args) -> dict:
+    farm = DeviceFarm(args.plug_devices, args.wda_boot)
+
+    async def run():
+        try:
+            await farm.plug_all(args.plug_interval, args.wda_boot * len(farm.udids) + 60)
+        finally:
+            await farm.stop()
+
+    try:
+        IOLoop.current().run_sync(run)
+    finally:
+        farm.cleanup()
+    latencies = [farm.ready[udid] - farm.plugged[udid] for udid in farm.udids]
+    return {
+        "devices": len(farm.udids),
+        "wda_boot_seconds": args.wda_boot,
+        "plug_to_ready_p50": round(percentile(latencies, .5), 3),
+        "plug_to_ready_max": round(max(latencies), 3),
+        "overhead_p50": round(percentile(latencies, .5) - args.wda_boot, 3),
+    }
+
+
+def scenario_cold(args) -> dict:
+    """
+    What POST /cold does to a ready device: change the public wdaproxy port
+    and health check wda. Timed until the new port answers /status.
+    """
+    farm = DeviceFarm(1, args.wda_boot, args.wdaproxy_mode)
+
+    async def run():
+        try:
+            await farm.plug_all(0)
+            d = farm.devices[farm.udids[0]]
+            async with httpx.AsyncClient() as client:
+                latencies = []
+                for _ in range(args.colds):
+                    await gen.sleep(args.cold_interval)  # a test job runs
+                    start = time.perf_counter()
+                    await d.rotate_wda_proxy()
+                    await d.wda_healthcheck()
+                    while True:
+                        try:
+                            url = "http://127.0.0.1:{}/status".format(d.public_port)
+                            (await client.get(url)).raise_for_status()
+                            break
+                        except httpx.HTTPError:
+                            await gen.sleep(.01)
+                    latencies.append(time.perf_counter() - start)
+            return latencies
+        finally:
+            await farm.stop()
+
+    try:
+        latencies = IOLoop.current().run_sync(run)
+    finally:
+        farm.cleanup()
+    return {
+        "colds": args.colds,
+        "wdaproxy_mode": args.wdaproxy_mode,
+        "cold_p50_ms": round(percentile(latencies, .5) * 1000, 1),
+        "cold_max_ms": round(max(latencies) * 1000, 1),
+    }
+
+
+def scenario_session(args) -> dict:
+    """
+    Test jobs one after another: POST /session without capabilities, check it,
+    DELETE /session/<id>. Timed until the session id is received.
+    """
+    farm = DeviceFarm(1, args.wda_boot, session_delay=args.session_delay,
+                      gateway_options=dict(session_pool=not args.no_session_pool))
+
+    async def run():
+        try:
+            await farm.plug_all(0)
+            d = farm.devices[farm.udids[0]]
+            url = "http://127.0.0.1:{}".format(d.public_port)
+            async with httpx.AsyncClient(timeout=60) as client:
+                latencies = []
+                for _ in range(args.jobs):
+                    await gen.sleep(args.job_interval)  # previous job finished
+                    start = time.perf_counter()
+                    r = await client.post(url + "/session", json={"capabilities": {}})
+                    r.raise_for_status()
+                    latencies.append(time.perf_counter() - start)
+                    session_url = url + "/session/" + r.json()['sessionId']
+                    (await client.get(session_url)).raise_for_status()
+                    (await client.delete(session_url)).raise_for_status()
+                stats = (await client.get(url + "/wdaproxy/session")).json() \
+                    if not args.no_session_pool else {}
+            return latencies, stats
+        finally:
+            await farm.stop()
+
+    try:
+        latencies, stats = IOLoop.current().run_sync(run)
+    finally:
+        farm.cleanup()
+    return {
+        "jobs": args.jobs,
+        "session_pool": not args.no_session_pool,
+        "pool_hits": stats.get("hits", 0),
+        "session_p50_ms": round(percentile(latencies, .5) * 1000, 1),
+        "session_max_ms": round(max(latencies) * 1000, 1),
+    }
+
+
+def scenario_screen(args) -> dict:
+    """
+    Fake WDA serves mjpeg at 10 fps by default, its /appium/settings change
+    the mjpeg server like WDA does.
+    """
+    farm = DeviceFarm(1, args.wda_boot)
+    options = {"fps": args.screen_fps, "scale": args.screen_scale}
+
+    async def run():
+        try:
+            await farm.plug_all(0)
+            d = farm.devices[farm.udids[0]]
+            url = "ws://127.0.0.1:{}/screen".format(d.public_port)
+            default = await _watch_screen(url, args.seconds)
+            single = await _watch_screen(url, args.seconds, options)
+            await gen.sleep(.5)  # settings restored
+            shared = await asyncio.gather(
+                _watch_screen(url, args.seconds + 1, {"fps": args.screen_fps}),
+                _watch_screen(url, args.seconds + 1, {"fps": args.screen_full_fps}))
+            await gen.sleep(.5)  # settings restored
+            return default, single, shared
+        finally:
+            await farm.stop()
+
+    try:
+        default, single, shared = IOLoop.current().run_sync(run)
+    finally:
+        farm.cleanup()
+
+    def rate(result: tuple, seconds: float = args.seconds) -> dict:
+        frames, nbytes = result
+        return {"fps": round(frames / seconds, 1),
+                "kilobytes_per_second": round(nbytes / seconds / 1e3, 1)}
+
+    return {
+        "options": options,
+        "default": rate(default),
+        "single_viewer": rate(single),
+        "shared_low_fps_viewer": rate(shared[0], args.seconds + 1),
+        "shared_full_fps_viewer": rate(shared[1], args.seconds + 1),
+    }
+
+
+def compare(before: dict, after: dict) -> dict:
+    """ change in percent of every number in both results """
+    changes = {}
+    for name, result in after.get("results", {}).items():
+        old = before.get("results", {}).get(name, {})
+        for key, value in result.items():
+            if isinstance(value, (int, float)) and isinstance(old.get(key), (int, float)) \
+                    and not isinstance(value, bool) and old[key] != value:
+                change = "{:+.1f}%".format((value - old[key]) * 100 / old[key]) if old[key] else None
+                changes.setdefault(name, {})[key] = [old[key], value, change]
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("scenarios", nargs="*", metavar="SCENARIO",
+                        help="some of: " + ", ".join(SCENARIOS) + ", default all")
+    parser.add_argument("-o", "--output", help="save results to json file")
+    parser.add_argument("--compare", help="results json of a previous run")
+    group = parser.add_argument_group("proxy")
+    group.add_argument("--requests", type=int, default=2000, help="requests to send")
+    group.add_argument("--concurrency", type=int, default=8, help="concurrent clients")
+    group.add_argument("--wda-latency", type=float, default=0.0, help="seconds of every wda response")
+    group.add_argument("--payload-size", type=int, default=4 << 10, help="wda /source bytes")
+    group = parser.add_argument_group("mjpeg")
+    group.add_argument("--viewers", type=int, default=4, help="/screen websocket clients")
+    group.add_argument("--fps", type=float, default=30, help="upstream frames per second")
+    group.add_argument("--resolution", default="750x1334", help="upstream frame size WIDTHxHEIGHT")
+    group.add_argument("--seconds", type=float, default=5, help="duration of watching")
+    group = parser.add_argument_group("heartbeat")
+    group.add_argument("--updates", type=int, default=20000, help="device updates to send")
+    group.add_argument("--devices", type=int, default=50, help="devices of heartbeat updates")
+    group.add_argument("--rate", type=float, default=0, help="updates per second, 0 for as fast as possible")
+    group.add_argument("--flush-interval", type=float, default=0.5, help="HeartbeatConnection flush_interval")
+    group = parser.add_argument_group("plug")
+    group.add_argument("--plug-devices", type=int, default=4, help="devices to plug")
+    group.add_argument("--plug-interval", type=float, default=0.1, help="seconds between plugs")
+    group.add_argument("--wda-boot", type=float, default=1.0, help="seconds fake wda takes to start")
+    group = parser.add_argument_group("cold")
+    group.add_argument("--colds", type=int, default=10, help="colds in a row")
+    group.add_argument("--cold-interval", type=float, default=1.0, help="seconds between colds")
+    group.add_argument("--wdaproxy-mode", choices=["gateway", "process"], default="gateway",
+                       help="wdaproxy in provider process, or a wdaproxy-script.py per device")
+    group = parser.add_argument_group("session")
+    group.add_argument("--jobs", type=int, default=5, help="test jobs in a row")
+    group.add_argument("--job-interval", type=float, default=3.0, help="seconds between jobs")
+    group.add_argument("--session-delay", type=float, default=2.0,
+                       help="seconds fake wda takes to create a session")
+    group.add_argument("--no-session-pool", action="store_true",
+                       help="no pre-created session")
+    group = parser.add_argument_group("screen")
+    group.add_argument("--screen-fps", type=int, default=5, help="fps asked by viewers")
+    group.add_argument("--screen-scale", type=int, default=50, help="scale percent asked by a single viewer")
+    group.add_argument("--screen-full-fps", type=int, default=10,
+                       help="fps asked by the other viewer while watching together")
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario: " + name)
+
+    os.chdir(ROOT)  # wdaproxy-script.py is started by relative path
+    results = {}
+    for name in args.scenarios or SCENARIOS:
+        print("running", name, file=sys.stderr)
+        results[name] = globals()["scenario_" + name](args)
+
+    report = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            report["compare"] = compare(json.load(f), report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+    print(json.dumps(report, indent=4))
+
+
+if __name__ == "__main__":
+    main()
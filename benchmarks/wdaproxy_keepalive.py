@@ -0,0 +1,42 @@
+# coding: utf-8
+#
+# Benchmark requests/s through wdaproxy-script.py against a local fake WDA
+#
+# "before": client connection closed after every request (--no-keep-alive)
+# "after": client keep-alive and pooled upstream connections
+#
+# Usage:
+#   python benchmarks/wdaproxy_keepalive.py --requests 2000 --concurrency 8
+
+import argparse
+import json
+
+from tornado.ioloop import IOLoop
+
+from fakes import FakeWDA, start_process, wait_port
+from suite import bench_proxy, stop
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000, help="requests of each run")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients")
+    args = parser.parse_args()
+
+    wda_port, wda = start_process(FakeWDA())
+    try:
+        IOLoop.current().run_sync(lambda: wait_port(wda_port))
+        results = {
+            "before": bench_proxy(wda_port, args.requests, args.concurrency,
+                                  ["--no-keep-alive", "--pool-size", "1",
+                                   "--pool-idle-timeout", "0"]),
+            "after": bench_proxy(wda_port, args.requests, args.concurrency),
+        }
+    finally:
+        stop(wda)
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
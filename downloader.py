@@ -0,0 +1,271 @@
+# coding: utf-8
+#
+# Download large files with parallel Range requests, resume after interrupted
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from logzero import logger
+
+RETRY_ERRORS = (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError)
+
+
+class DownloadError(IOError):
+    pass
+
+
+class RangeIgnored(DownloadError):
+    """ server answered a Range request with the whole content """
+
+
+class _Transfer(object):
+    """ one download() call, segments are list of [start, end(inclusive), next offset] """
+
+    def __init__(self, downloader, url: str, path: str, validator: str, size: int,
+                 segments: list):
+        self.d = downloader
+        self.url = url
+        self.path = path
+        self.validator = validator
+        self.size = size
+        self.segments = segments
+        self.retries = 0
+        self.stopped = False  # set when any segment failed
+        self._lock = threading.Lock()
+
+    @property
+    def state_path(self) -> str:
+        return self.path + ".json"
+
+    @property
+    def done_bytes(self) -> int:
+        return sum(seg[2] - seg[0] for seg in self.segments)
+
+    def save_state(self):
+        with self._lock:
+            try:
+                with open(self.state_path, "w", encoding="utf-8") as f:
+                    json.dump({
+                        "url": self.url,
+                        "validator": self.validator,
+                        "size": self.size,
+                        "segments": self.segments,
+                    }, f)
+            except OSError as e:
+                logger.warning("save download state error: %s", e)
+
+    def load_state(self) -> bool:
+        """ load segments saved by the interrupted download of the same content """
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if os.path.getsize(self.path) != self.size:
+                return False
+        except (OSError, ValueError):
+            return False
+        if (state.get('url'), state.get('validator'), state.get('size')) != \
+                (self.url, self.validator, self.size):
+            return False
+        self.segments = state['segments']
+        return True
+
+    def remove_state(self):
+        try:
+            os.unlink(self.state_path)
+        except FileNotFoundError:
+            pass
+
+    def retry(self, fn):
+        attempts = 0
+        while True:
+            try:
+                return fn()
+            except RETRY_ERRORS as e:
+                attempts += 1
+                if attempts > self.d.retries or self.stopped:
+                    raise
+                self.retries += 1
+                logger.warning("download %s error: %s, retry %d", self.url, e, attempts)
+                time.sleep(min(2**(attempts - 1), 10))
+
+    def run_segments(self):
+        if not os.path.exists(self.path):
+            with open(self.path, "wb") as f:
+                f.truncate(self.size)  # preallocate
+        self.save_state()
+        todo = [seg for seg in self.segments if seg[2] <= seg[1]]
+        with ThreadPoolExecutor(len(todo) or 1) as executor:
+            futures = [executor.submit(self._run_segment, seg) for seg in todo]
+            try:
+                # the first failure is the cause, others are stopped by it
+                for future in as_completed(futures):
+                    future.result()
+            finally:
+                self.stopped = True  # other segments stop at once
+                self.save_state()
+
+    def _run_segment(self, seg: list):
+        with open(self.path, "r+b") as f:
+            self.retry(lambda: self._fetch_range(f, seg))
+
+    def _fetch_range(self, f, seg: list):
+        headers = {
+            "Range": "bytes={}-{}".format(seg[2], seg[1]),
+            "If-Range": self.validator,
+        }
+        with requests.get(self.url, headers=headers, stream=True,
+                          timeout=self.d.timeout) as r:
+            if r.status_code != 206:
+                raise RangeIgnored("range request not satisfied: {}".format(r.status_code))
+            f.seek(seg[2])
+            saved = seg[2]
+            for chunk in r.iter_content(chunk_size=self.d.chunk_size):
+                if self.stopped:
+                    raise DownloadError("stopped by failure of other segment")
+                f.write(chunk)
+                seg[2] += len(chunk)
+                if seg[2] - saved >= 16 << 20:
+                    saved = seg[2]
+                    f.flush()
+                    self.save_state()
+        if seg[2] <= seg[1]:
+            raise requests.ConnectionError("connection closed at {} of {}".format(
+                seg[2], seg[1] + 1))
+
+    def run_stream(self, r: requests.Response, ranges: bool):
+        """ single stream, continue with Range request after interrupted when ranges is True """
+        seg = self.segments[0]
+        encoded = bool(r.headers.get("Content-Encoding"))
+
+        def fetch():
+            nonlocal r
+            if r is None:
+                headers = {}
+                if ranges:
+                    headers['Range'] = "bytes={}-".format(seg[2])
+                    headers['If-Range'] = self.validator
+                r = requests.get(self.url, headers=headers, stream=True,
+                                 timeout=self.d.timeout)
+            try:
+                r.raise_for_status()
+                if r.status_code != 206:
+                    seg[2] = 0  # start over
+                with open(self.path, "r+b" if seg[2] else "wb") as f:
+                    f.seek(seg[2])
+                    for chunk in r.iter_content(chunk_size=self.d.chunk_size):
+                        f.write(chunk)
+                        seg[2] += len(chunk)
+                    f.truncate()
+            finally:
+                r.close()
+                r = None
+            if self.size and not encoded and seg[2] != self.size:
+                raise requests.ConnectionError(
+                    "download incomplete, expect {} bytes got {}".format(self.size, seg[2]))
+
+        try:
+            self.retry(fetch)
+        except BaseException:
+            if ranges:
+                self.save_state()
+            raise
+
+
+class RangeDownloader(object):
+    """
+    Files larger than 2*min_segment_size from servers with "Accept-Ranges: bytes"
+    are split into segments, downloaded in parallel into a preallocated file.
+    Others are downloaded in a single stream.
+
+    Progress is saved to <path>.json, an interrupted download continues from
+    where it stopped, both within retries and by the next download() of the
+    same path, as long as ETag/Last-Modified and size are unchanged.
+    When Range requests are answered by 200, the file is downloaded again in a
+    single stream.
+
+    Example usage:
+
+    stats = RangeDownloader().download(url, "app.ipa")
+    print(stats["bytesPerSecond"])
+    """
+
+    def __init__(self,
+                 segments: int = 4,
+                 min_segment_size: int = 8 << 20,
+                 chunk_size: int = 1 << 16,
+                 retries: int = 3,
+                 timeout: float = 30):
+        self.segments = segments
+        self.min_segment_size = min_segment_size
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.timeout = timeout
+
+    def _split(self, size: int) -> list:
+        count = max(1, min(self.segments, size // self.min_segment_size))
+        step = -(-size // count)  # ceil
+        return [[i, min(i + step, size) - 1, i] for i in range(0, size, step)]
+
+    def download(self, url: str, path: str, response: requests.Response = None) -> dict:
+        """
+        Args:
+            response: GET response of url opened with stream=True, closed when returned
+
+        Returns:
+            dict of bytes, seconds, bytesPerSecond, segments, resumedBytes, retries
+
+        Raises:
+            requests.RequestException, IOError
+        """
+        start = time.time()
+        r = response or requests.get(url, stream=True, timeout=self.timeout)
+        try:
+            r.raise_for_status()
+            size = int(r.headers.get("Content-Length") or 0)
+            etag = r.headers.get("ETag")
+            if etag and etag.startswith("W/"):
+                etag = None  # weak etag is not allowed in If-Range, RFC 7233 3.2
+            validator = etag or r.headers.get("Last-Modified")
+            ranges = bool(size and validator and r.headers.get("Accept-Ranges") == "bytes" and
+                          not r.headers.get("Content-Encoding"))  # yapf: disable
+            t = _Transfer(self, url, path, validator, size, [[0, size - 1, 0]])
+            if ranges and not t.load_state():
+                t.segments = self._split(size)
+                if len(t.segments) > 1 and os.path.exists(path):
+                    os.unlink(path)  # content changed
+            resumed = t.done_bytes
+            if resumed:
+                logger.info("resume download of %s from %d bytes", url, resumed)
+
+            if ranges and (len(t.segments) > 1 or resumed):
+                r.close()
+                try:
+                    t.run_segments()
+                except RangeIgnored as e:
+                    logger.warning("%s, download %s in a single stream", e, url)
+                    t.remove_state()
+                    t = _Transfer(self, url, path, validator, size, [[0, size - 1, 0]])
+                    resumed = 0
+                    r = requests.get(url, stream=True, timeout=self.timeout)
+                    t.run_stream(r, False)
+            else:
+                t.run_stream(r, ranges)
+        finally:
+            r.close()
+
+        t.remove_state()
+        elapsed = time.time() - start
+        nbytes = os.path.getsize(path)
+        return {
+            "bytes": nbytes,
+            "seconds": round(elapsed, 3),
+            "bytesPerSecond": int((nbytes - resumed) / elapsed) if elapsed else 0,
+            "segments": len(t.segments),
+            "resumedBytes": resumed,
+            "retries": t.retries,
+        }
@@ -1,26 +1,134 @@
 # coding: utf-8
 #
 
+import os
 import socket
+import threading
+from collections import deque
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
 
 
 class FreePort(object):
-    def __init__(self):
-        self._start = 20000
-        self._end = 40000
-        self._now = self._start-1
-
-    def get(self):
-        while True:
-            self._now += 1
-            if self._now > self._end:
-                self._now = self._start
-            if not self.is_port_in_use(self._now):
-                return self._now
+    """
+    Allocate ports in [start, end], every port is reserved by an owner until released.
 
-    def is_port_in_use(self, port):
+    Ports are verified by bind, released ports go to the end of the free list so
+    they are not reused immediately. When lock_dir is set, a flock on
+    <lock_dir>/<port>.lock is held for every reserved port, so providers running
+    on the same host never hand out the same port.
+
+    Example usage:
+
+    port = freeport.get(("xxxx-udid", "wda"))
+    freeport.release_owner("xxxx-udid") # release all ports of device
+    """
+
+    def __init__(self, start: int = 20000, end: int = 40000, lock_dir: str = None):
+        self._start = start
+        self._end = end
+        self._free = deque(range(start, end + 1))
+        self._owners = {}  # port -> owner
+        self._ports = {}  # owner -> port
+        self._lock_files = {}  # port -> file object holding flock
+        self._mutex = threading.Lock()
+        self._lock_dir = None
+        if lock_dir:
+            self.enable_lock_dir(lock_dir)
+
+    def enable_lock_dir(self, lock_dir: str):
+        if fcntl is None:
+            raise EnvironmentError("port lock file is not supported on this os")
+        os.makedirs(lock_dir, exist_ok=True)
+        self._lock_dir = lock_dir
+
+    def get(self, owner=None) -> int:
+        """
+        Args:
+            owner: eg: (udid, "wda"), previous port of the same owner is released
+
+        Raises:
+            RuntimeError: when no port available
+        """
+        with self._mutex:
+            for _ in range(len(self._free)):
+                port = self._free.popleft()
+                if self._lock_port(port) and self.is_port_free(port):
+                    break
+                self._unlock_port(port)
+                self._free.append(port)
+            else:
+                raise RuntimeError("no free port in range", self._start, self._end)
+
+            if owner is not None:
+                old_port = self._ports.get(owner)
+                if old_port is not None:
+                    self._release(old_port)
+                self._ports[owner] = port
+            self._owners[port] = owner
+            return port
+
+    def swap(self, owner, other):
+        """ exchange reserved ports of two owners """
+        with self._mutex:
+            port, other_port = self._ports[owner], self._ports[other]
+            self._ports[owner], self._ports[other] = other_port, port
+            self._owners[port], self._owners[other_port] = other, owner
+
+    def release(self, port: int):
+        with self._mutex:
+            self._release(port)
+
+    def release_owner(self, name):
+        """ release ports of owner, or of all owners whose first item is name """
+        with self._mutex:
+            for port, owner in list(self._owners.items()):
+                if owner == name or (isinstance(owner, tuple) and owner[0] == name):
+                    self._release(port)
+
+    def _release(self, port: int):
+        if port not in self._owners:
+            return
+        owner = self._owners.pop(port)
+        if self._ports.get(owner) == port:
+            del self._ports[owner]
+        self._unlock_port(port)
+        self._free.append(port)
+
+    def owner(self, port: int):
+        return self._owners.get(port)
+
+    def _lock_port(self, port: int) -> bool:
+        if not self._lock_dir:
+            return True
+        f = open(os.path.join(self._lock_dir, "{}.lock".format(port)), "a")
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._lock_files[port] = f
+        return True
+
+    def _unlock_port(self, port: int):
+        f = self._lock_files.pop(port, None)
+        if f:
+            f.close()  # flock released with file closed
+
+    def is_port_free(self, port: int) -> bool:
+        """ bind check, also detect port bound but not listening """
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            return s.connect_ex(('localhost', port)) == 0
+            try:
+                s.bind(('', port))
+                return True
+            except OSError:
+                return False
+
+    def is_port_in_use(self, port):
+        return not self.is_port_free(port)
 
 
 freeport = FreePort()
@@ -28,4 +136,4 @@ freeport = FreePort()
 
 if __name__ == "__main__":
     for i in range(10):
-        print(freeport.get())
\ No newline at end of file
+        print(freeport.get())
@@ -5,7 +5,7 @@
 
 import json
 import re
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 
 from logzero import logger
 from tornado.ioloop import IOLoop
@@ -20,11 +20,13 @@ async def heartbeat_connect(server_url: str,
                             self_url: str = "",
                             secret: str = "",
                             platform: str = "android",
-                            priority: int = 2):
+                            priority: int = 2,
+                            flush_interval: float = 0.5):
     addr = server_url.replace("http://", "").replace("/", "")
     url = "ws://" + addr + "/websocket/heartbeat"
     hbc = HeartbeatConnection(
-        url, secret, platform=platform, priority=priority)
+        url, secret, platform=platform, priority=priority,
+        flush_interval=flush_interval)
     hbc._provider_url = self_url
     await hbc.open()
     return hbc
@@ -40,13 +42,17 @@ class SafeWebSocket(websocket.WebSocketClientConnection):
 class HeartbeatConnection(object):
     """
     与atxserver2建立连接，汇报当前已经连接的设备
+
+    device_update messages queued within flush_interval seconds are merged per udid,
+    so the server only receives the latest state of every device.
     """
 
     def __init__(self,
                  url="ws://localhost:4000/websocket/heartbeat",
                  secret='',
                  platform='android',
-                 priority=2):
+                 priority=2,
+                 flush_interval=0.5):
         self._ws_url = url
         self._provider_url = None
         self._name = "pyclient"
@@ -57,6 +63,8 @@ class HeartbeatConnection(object):
         self._priority = priority
         self._queue = Queue()
         self._db = defaultdict(dict)
+        self._flush_interval = flush_interval
+        self.messages_saved = 0  # updates merged into others
 
     async def open(self):
         self._ws = await self.connect()
@@ -66,28 +74,49 @@ class HeartbeatConnection(object):
     async def _drain_queue(self):
         """
         Logic:
-            - send message to server when server is alive
+            - wait flush_interval to collect more messages
+            - merge updates of the same udid
             - update local db
+            - send message to server when server is alive
         """
         while True:
-            message = await self._queue.get()
-            if message is None:
+            messages = [await self._queue.get()]
+            if self._flush_interval > 0:
+                await gen.sleep(self._flush_interval)
+            while self._queue.qsize():
+                messages.append(self._queue.get_nowait())
+
+            resend = False
+            updates = 0
+            merged = OrderedDict()  # udid -> message
+            others = []
+            for message in messages:
+                self._queue.task_done()
+                if message is None:
+                    resend = True
+                elif 'udid' in message:  # ping消息不包含在裡面
+                    udid = message['udid']
+                    update_recursive(self._db, {udid: message})
+                    update_recursive(merged.setdefault(udid, {}), message)
+                    updates += 1
+                else:
+                    others.append(message)
+            self.messages_saved += updates - len(merged)
+
+            if resend:
                 logger.info("Resent messages: %s", self._db)
-                for _, v in self._db.items():
-                    await self._ws.write_message(v)
-                continue
-
-            if 'udid' in message:  # ping消息不包含在裡面
-                udid = message['udid']
-                update_recursive(self._db, {udid: message})
-            self._queue.task_done()
-
-            if self._ws:
-                try:
-                    await self._ws.write_message(message)
-                    logger.debug("websocket send: %s", message)
-                except TypeError as e:
-                    logger.info("websocket write_message error: %s", e)
+                merged = self._db  # already contains merged updates
+
+            for message in list(merged.values()) + others:
+                await self._write_message(message)
+
+    async def _write_message(self, message: dict):
+        if self._ws:
+            try:
+                await self._ws.write_message(message)
+                logger.debug("websocket send: %s", message)
+            except TypeError as e:
+                logger.info("websocket write_message error: %s", e)
 
     async def _drain_ws_message(self):
         while True:
@@ -147,6 +176,18 @@ class HeartbeatConnection(object):
 
         await self._queue.put(data)
 
+    def queue_size(self) -> int:
+        """ device updates waiting to be sent """
+        return self._queue.qsize()
+
+    def update_provider_url(self, url: str):
+        """ handshake again with new url, queued device updates are resent after reconnected """
+        if url == self._provider_url:
+            return
+        self._provider_url = url
+        if self._ws:
+            self._ws.close()  # reconnected by _drain_ws_message
+
     async def ping(self):
         await self._ws.write_message({"command": "ping"})
 
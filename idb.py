@@ -2,12 +2,17 @@
 #
 # require: python >= 3.6
 
+import asyncio
 import base64
 import json
 import os
+import plistlib
 import re
+import socket
+import struct
 import sys
 import subprocess
+import threading
 import time
 from collections import namedtuple
 from concurrent.futures import ThreadPoolExecutor
@@ -20,12 +25,37 @@ from logzero import logger
 from tornado import gen, httpclient, locks
 from tornado.concurrent import run_on_executor
 from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.queues import Queue
+from tornado.tcpclient import TCPClient
 
+import metrics
 from freeport import freeport
+from registry import registry
+from scheduler import LaunchScheduler, health_scheduler
+from simctl import simctl
+from supervisor import ProcessSupervisor
 from tidevice import Device
 from tidevice._usbmux import Usbmux
 
 DeviceEvent = namedtuple('DeviceEvent', ['present', 'udid'])
+# xcodebuild output when test runner is installed and started
+LAUNCHED_RE = re.compile(r"Test Suite '.*' started|ServerURLHere->")
+# printed by WebDriverAgent once its http server is listening
+SERVER_URL_RE = re.compile(r"ServerURLHere->(.*?)<-ServerURLHere")
+# launcher output which means wda will never be ready
+FATAL_RE = re.compile("|".join([
+    r"\*\* TEST (EXECUTE )?FAILED \*\*",
+    r"Testing failed:",
+    r"xcodebuild: error:",
+    r"Failed to install or launch the test runner",
+    r"Unable to find a destination matching",
+    r"requires a development team",
+    r"No profiles for '.*' were found",
+    r"could not be, unlocked",
+    r"No app matches",
+    r"MuxError",
+]))  # yapf: disable
 um = Usbmux()
 
 
@@ -40,95 +70,239 @@ def runcommand(*args) -> str:
         return ""
 
 
-def list_devices():
-    devices = um.device_list()
+def list_devices(usbmux: Usbmux = None):
+    devices = (usbmux or um).device_list()
     udids = [device.udid for device in devices]
-    udid_sim = runcommand('xcrun', 'simctl', 'list', 'devices').splitlines()
-    p = re.compile(r'[(](.*?)[)]', re.S)
-    udids.extend([re.findall(p, i)[-2] for i in udid_sim if 'Booted' in i])
+    udids.extend([sim.udid for sim in simctl.booted()])
     return udids
 
 
-def udid2name(udid: str) -> str:
-    devices = um.device_list()
-    for device in devices:
-        if device.udid == udid:
-            d = Device(device.udid)
-            return d.get_value(no_session=True).get('DeviceName')
-    if not devices:  # 模拟器
-        udid_sim = runcommand('xcrun', 'simctl', 'list', 'devices').splitlines()
-        for i in udid_sim:
-            if udid in i:
-                return i[:i.index('(')].strip()
-    return "Unknown"
+MODELS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "models.json")
+DEVICE_INFO_PATH = os.path.expanduser("~/.atxserver2-ios-provider/devices.json")
+# lockdown values kept in DEVICE_INFO_PATH, others (eg: IMEI, phone number) are not stored
+DEVICE_INFO_KEYS = ("DeviceName", "ProductType", "ProductVersion")
 
+_models = None
 
-def udid2product(udid):
+
+def load_models() -> dict:
     """
+    ProductType -> model name, loaded once from models.json
+
     See also: https://www.theiphonewiki.com/wiki/Models
     """
-    pt = ""
-    devices = um.device_list()
-    for device in devices:
-        if device.udid == udid:
-            d = Device(device.udid)
-            pt = d.get_value(no_session=True).get('ProductType')
-    models = {
-        "iPhone5,1": "iPhone 5",
-        "iPhone5,2": "iPhone 5",
-        "iPhone5,3": "iPhone 5c",
-        "iPhone5,4": "iPhone 5c",
-        "iPhone6,1": "iPhone 5s",
-        "iPhone6,2": "iPhone 5s",
-        "iPhone7,1": "iPhone 6 Plus",
-        "iPhone7,2": "iPhone 6",
-        "iPhone8,1": "iPhone 6s",
-        "iPhone8,2": "iPhone 6s Plus",
-        "iPhone8,4": "iPhone SE",
-        "iPhone9,1": "iPhone 7",  # Global
-        "iPhone9,2": "iPhone 7 Plus",  # Global
-        "iPhone9,3": "iPhone 7",  # GSM
-        "iPhone9,4": "iPhone 7 Plus",  # GSM
-        "iPhone10,1": "iPhone 8",  # Global
-        "iPhone10,2": "iPhone 8 Plus",  # Global
-        "iPhone10,3": "iPhone X",  # Global
-        "iPhone10,4": "iPhone 8",  # GSM
-        "iPhone10,5": "iPhone 8 Plus",  # GSM
-        "iPhone10,6": "iPhone X",  # GSM
-        "iPhone11,2": "iPhone XS",
-        "iPhone11,4": "iPhone XS Max",
-        "iPhone11,6": "iPhone XS Max",
-        "iPhone11,8": "iPhone XR",
-        "iPhone12,1": "iPhone 11",
-        "iPhone12,3": "iPhone 11 Pro",
-        "iPhone12,5": "iPhone 11 Pro Max",
-        "iPhone12,8": "iPhone SE 2nd",
-        "iPhone13,1": "iPhone 12 mini",
-        "iPhone13,2": "iPhone 12",
-        "iPhone13,3": "iPhone 12 Pro",
-        "iPhone13,4": "iPhone 12 Pro Max",
-        "iPhone14,2": "iPhone 13 Pro",
-        "iPhone14,3": "iPhone 13 Pro Max",
-        "iPhone14,4": "iPhone 13 mini",
-        "iPhone14,5": "iPhone 13",
-        # simulator
-        "i386": "iPhone Simulator",
-        "x86_64": "iPhone Simulator",
-    }
+    global _models
+    if _models is None:
+        with open(MODELS_PATH, "r", encoding="utf-8") as f:
+            _models = json.load(f)
+    return _models
+
+
+class DeviceInfoCache(object):
+    """
+    Lockdown values (DEVICE_INFO_KEYS) of devices, persisted to disk keyed by UDID.
+    They are fetched in one lockdown query, and only fetched again when refresh=True
+    """
+
+    def __init__(self, path: str = DEVICE_INFO_PATH):
+        self._path = path
+        self._db = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self._path, "r", encoding="utf-8") as f:
+                db = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("load device info cache %s error: %s", self._path, e)
+            return
+        self._db = {udid: self._filter(info) for udid, info in db.items()}
+        if self._db != db:  # written by older versions with all lockdown values
+            self._save()
+
+    @staticmethod
+    def _filter(info: dict) -> dict:
+        return {k: v for k, v in info.items() if k in DEVICE_INFO_KEYS}
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            tmp_path = self._path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._db, f, indent=4, ensure_ascii=False)
+            os.replace(tmp_path, self._path)
+        except OSError as e:
+            logger.warning("save device info cache %s error: %s", self._path, e)
+
+    def _fetch(self, udid: str) -> dict:
+        devices = um.device_list()
+        for device in devices:
+            if device.udid == udid:
+                values = Device(device.udid).get_value(no_session=True)
+                return self._filter(values)
+        sim = simctl.get(udid)  # 模拟器
+        if sim:
+            _, _, version = sim.runtime.partition(" ")
+            return {"DeviceName": sim.name, "ProductVersion": version}
+        return {}
+
+    def get(self, udid: str, refresh: bool = False) -> dict:
+        """
+        Returns:
+            dict of lockdown values, empty dict when device not found
+        """
+        with self._lock:
+            if not refresh and udid in self._db:
+                return self._db[udid]
+            info = self._fetch(udid)
+            if info:
+                self._db[udid] = info
+                self._save()
+            return info
+
+
+device_info_cache = DeviceInfoCache()
+
+
+def udid2name(udid: str, refresh: bool = False) -> str:
+    info = device_info_cache.get(udid, refresh)
+    return info.get('DeviceName') or "Unknown"
+
+
+def udid2product(udid: str, refresh: bool = False) -> str:
+    pt = device_info_cache.get(udid, refresh).get('ProductType')
     if not pt:
         pt = "i386"
-    return models.get(pt, "Unknown")
+    return load_models().get(pt, "Unknown")
+
+
+class UsbmuxListener():
+    """
+    Async client of usbmuxd Listen stream
+
+    Example usage:
+
+    async for msg in UsbmuxListener().listen():
+        print(msg['MessageType'], msg['DeviceID'])
+
+    Messages looks like
+    - {'MessageType': 'Result', 'Number': 0} (always the first one)
+    - {'DeviceID': 59, 'MessageType': 'Attached', 'Properties': {'SerialNumber': 'xxxx', ...}}
+    - {'DeviceID': 59, 'MessageType': 'Detached'}
+    """
+
+    def __init__(self, address=None):
+        """
+        Args:
+            address: unix socket path or (host, port), default usbmuxd address of current os
+        """
+        if address is None:
+            address = ('127.0.0.1', 27015) if os.name == "nt" else "/var/run/usbmuxd"
+        self._address = address
+        self._tag = 0
+        self._stream = None
+
+    def close(self):
+        """ close current connection, make listen() stop """
+        if self._stream:
+            self._stream.close()
+
+    async def _connect(self) -> IOStream:
+        if isinstance(self._address, str):
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, 0)
+        else:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+        stream = IOStream(s)
+        await stream.connect(self._address)
+        return stream
+
+    async def _send_packet(self, stream: IOStream, payload: dict):
+        # header: length, version(1: plist), message(8: plist), tag
+        self._tag += 1
+        body = plistlib.dumps(payload)
+        header = struct.pack("<IIII", 16 + len(body), 1, 8, self._tag)
+        await stream.write(header + body)
+
+    async def _recv_packet(self, stream: IOStream) -> dict:
+        header = await stream.read_bytes(16)
+        length, _, _, _ = struct.unpack("<IIII", header)
+        body = await stream.read_bytes(length - 16)
+        return plistlib.loads(body)
+
+    async def listen(self):
+        """
+        Raises:
+            OSError, StreamClosedError, RuntimeError
+        """
+        stream = self._stream = await self._connect()
+        try:
+            await self._send_packet(stream, {
+                "MessageType": "Listen",
+                "ClientVersionString": "libusbmuxd 1.1.0",
+                "ProgName": "atxserver2-ios-provider",
+                "kLibUSBMuxVersion": 3,
+            })
+            reply = await self._recv_packet(stream)
+            if reply.get('Number', 0) != 0:
+                raise RuntimeError("usbmuxd refused listen", reply)
+            yield reply
+            while True:
+                yield await self._recv_packet(stream)
+        finally:
+            stream.close()
+            if self._stream is stream:
+                self._stream = None
 
 
 class Tracker():
+    """
+    Track device plugin and plugout
+
+    When listen is True, usbmuxd Attached/Detached messages are turned into
+    DeviceEvent as soon as they arrive, and list_devices() only runs every
+    reconcile_interval seconds (to catch simulators and missed messages).
+    While usbmuxd listen connection is broken, fallback to poll every poll_interval.
+    stop() ends both loops and track_devices().
+    """
     executor = ThreadPoolExecutor(4)
 
-    def __init__(self):
+    def __init__(self,
+                 listen: bool = False,
+                 poll_interval: float = 1.0,
+                 reconcile_interval: float = 30.0,
+                 usbmux_address=None):
         self._lasts = []
+        self._listen = listen
+        self._listening = False
+        self._poll_interval = poll_interval
+        self._reconcile_interval = reconcile_interval
+        self._usbmux = Usbmux(usbmux_address) if usbmux_address else um
+        self._listener = UsbmuxListener(usbmux_address)
+        self._device_ids = {}  # DeviceID -> udid
+        self._generation = 0  # increased on every usbmuxd message
+        self._events = Queue()
+        self._stopped = locks.Event()
+
+    def stop(self):
+        self._stopped.set()
+        self._listener.close()
+        self._events.put_nowait(None)
+
+    async def _sleep(self, timeout: float) -> bool:
+        """ return False when stop() called """
+        try:
+            await self._stopped.wait(IOLoop.current().time() + timeout)
+            return False
+        except tornado.util.TimeoutError:
+            return True
 
     @run_on_executor(executor='executor')
     def list_devices(self):
-        return list_devices()
+        return list_devices(self._usbmux)
 
     @gen.coroutine
     def update(self):
@@ -140,19 +314,87 @@ class Tracker():
         self._lasts = currs
         raise gen.Return((backs, gones))
 
+    def _emit(self, present: bool, udid: str):
+        if present == (udid in self._lasts):
+            return
+        if present:
+            self._lasts = self._lasts + [udid]
+        else:
+            self._lasts = [u for u in self._lasts if u != udid]
+        self._events.put_nowait(DeviceEvent(present, udid))
+
+    def _handle_usbmux_message(self, msg: dict):
+        self._generation += 1
+        device_id = msg.get('DeviceID')
+        if msg.get('MessageType') == 'Attached':
+            props = msg.get('Properties', {})
+            udid = props.get('SerialNumber') or props.get('UDID')
+            if not udid:
+                return
+            self._device_ids[device_id] = udid
+            self._emit(True, udid)
+        elif msg.get('MessageType') == 'Detached':
+            udid = self._device_ids.pop(device_id, None)
+            # same device may be attached both by USB and network
+            if udid and udid not in self._device_ids.values():
+                self._emit(False, udid)
+
+    async def _listen_forever(self):
+        wait = 1
+        while not self._stopped.is_set():
+            try:
+                async for msg in self._listener.listen():
+                    if not self._listening:
+                        logger.info("usbmuxd listen connected")
+                        self._listening = True
+                        wait = 1
+                    self._handle_usbmux_message(msg)
+            except (OSError, StreamClosedError, RuntimeError) as e:
+                if self._stopped.is_set():
+                    break
+                logger.warning("usbmuxd listen error: %s, retry after %ds", e,
+                               wait)
+            self._listening = False
+            self._device_ids = {}
+            if not await self._sleep(wait):
+                break
+            wait = min(30, wait * 2)
+
+    async def _reconcile_forever(self):
+        while not self._stopped.is_set():
+            generation = self._generation
+            try:
+                currs = await self.list_devices()
+            except Exception as e:  # eg: usbmuxd is restarting
+                logger.warning("list devices error: %s, retry after %.1fs", e,
+                               self._poll_interval)
+                currs = None
+            if currs is not None and generation == self._generation:
+                # skip when usbmuxd messages arrived during list_devices
+                for udid in set(currs).difference(self._lasts):
+                    self._emit(True, udid)
+                for udid in set(self._lasts).difference(currs):
+                    self._emit(False, udid)
+            if self._listening and currs is not None:
+                interval = self._reconcile_interval
+            else:
+                interval = self._poll_interval
+            if not await self._sleep(interval):
+                break
+
     async def track_devices(self):
+        if self._listen:
+            IOLoop.current().spawn_callback(self._listen_forever)
+        IOLoop.current().spawn_callback(self._reconcile_forever)
         while True:
-            backs, gones = await self.update()
-            for udid in backs:
-                yield DeviceEvent(True, udid)
-
-            for udid in gones:
-                yield DeviceEvent(False, udid)
-            await gen.sleep(1)
+            event = await self._events.get()
+            if event is None:  # stopped
+                return
+            yield event
 
 
-def track_devices():
-    t = Tracker()
+def track_devices(listen: bool = False, **kwargs):
+    t = Tracker(listen=listen, **kwargs)
     return t.track_devices()
 
 
@@ -164,12 +406,12 @@ class WDADevice(object):
     """
     Example usage:
 
-    lock = locks.Lock() # xcodebuild test is not support parallel run
+    scheduler = LaunchScheduler() # xcodebuild test is not support parallel run
     
     async def callback(device: WDADevice, status, info=None):
         pass
 
-    d = WDADevice("xxxxxx-udid-xxxxx", lock, callback)
+    d = WDADevice("xxxxxx-udid-xxxxx", scheduler, callback)
     d.start()
     await d.stop()
     """
@@ -178,28 +420,43 @@ class WDADevice(object):
     status_ready = "ready"
     status_fatal = "fatal"
 
-    def __init__(self, udid: str, lock: locks.Lock, callback):
+    def __init__(self, udid: str, scheduler: LaunchScheduler, callback,
+                 refresh_info: bool = False):
         """
         Args:
             callback: function (str, dict) -> None
+            refresh_info: query lockdown again instead of using cached name and product
         
         Example callback:
             callback("update", {"ip": "1.2.3.4"})
         """
         self.__udid = udid
-        self.name = udid2name(udid)
-        self.product = udid2product(udid)
+        self.name = udid2name(udid, refresh_info)
+        self.product = udid2product(udid)  # refreshed by udid2name
         self.wda_directory = "./ATX-WebDriverAgent"
-        self._procs = []
+        self._supervisor = ProcessSupervisor(udid[:7])
+        self._supervisor.on_change = self._processes_changed
+        self._wda_port = None
+        self._mjpeg_port = None
         self._wda_proxy_port = None
-        self._wda_proxy_proc = None
-        self._lock = lock  # only allow one xcodebuild test run
+        self._standby_proxy_port = None  # listening, becomes public by rotate_wda_proxy()
+        self._proxy_lock = locks.Lock()
+        self._standby_renewal = None  # Future of _renew_standby_proxy, awaited by next rotation
+        self._scheduler = scheduler  # only allow one xcodebuild test run
+        self._launched = locks.Event()  # set when test runner is installed and started
+        self._listening = locks.Event()  # set when launcher printed ServerURLHere
+        self._launch_fatal = locks.Event()  # set when launcher printed FATAL_RE
+        self.fatal_output = None  # launcher output line which matched FATAL_RE
         self._finished = locks.Event()
         self._stop = locks.Event()
+        self._unhealthy = locks.Event()  # set by health_scheduler
         self._callback = partial(callback, self) or nop_callback
+        self.status = None  # last status passed to callback
         self.manually_start_wda = False
         self.use_tidevice = False
         self.wda_bundle_pattern = "*WebDriverAgent*"
+        self.proxy_gateway = None  # wdaproxy.WDAProxyGateway, None: run wdaproxy-script.py
+        self.launch_wait_time = 0.0  # seconds waited in launch queue
 
 
     @property
@@ -210,6 +467,14 @@ class WDADevice(object):
     def public_port(self):
         return self._wda_proxy_port
 
+    @property
+    def ports(self) -> dict:
+        return {
+            "wda": self._wda_port,
+            "mjpeg": self._mjpeg_port,
+            "proxy": self._wda_proxy_port,
+        }
+
     def __repr__(self):
         return "[{udid}:{name}-{product}]".format(udid=self.udid[:5] + ".." +
                                                   self.udid[-2:],
@@ -219,6 +484,10 @@ class WDADevice(object):
     def __str__(self):
         return repr(self)
 
+    async def _set_status(self, status: str, info: dict = None):
+        self.status = status
+        await self._callback(status, info)
+
     def start(self):
         """ start wda process and keep it running, until wda stopped too many times or stop() called """
         self._stop.clear()
@@ -241,11 +510,12 @@ class WDADevice(object):
         """
         wda_fail_cnt = 0
         while not self._stop.is_set():
-            await self._callback(self.status_preparing)
+            await self._set_status(self.status_preparing)
             start = time.time()
             ok = await self.run_webdriveragent()
             if not ok:
-                self.destroy()
+                await self.destroy()
+                metrics.wda_restarts_total.inc(reason="launch_failed")
 
                 wda_fail_cnt += 1
                 if wda_fail_cnt > 3:
@@ -261,21 +531,41 @@ class WDADevice(object):
                 continue
 
             wda_fail_cnt = 0
-            logger.info("%s wda lanuched", self)
+            logger.info("%s wda lanuched, waited %.1fs in launch queue", self,
+                        self.launch_wait_time)
 
             # wda_status() result stored in __wda_info
-            await self._callback(self.status_ready, self.__wda_info)
+            await self._set_status(self.status_ready, self.__wda_info)
+            if self.session_pool:
+                self.session_pool.fill()
             await self.watch_wda_status()
 
-        await self._callback(self.status_fatal)
-        self.destroy()  # destroy twice to make sure no process left
+        if not self._stop.is_set():
+            metrics.wda_fatal_total.inc()
+        if "Simulator" in self.product:
+            simctl.invalidate()  # simulator may be shutdown
+        await self._set_status(self.status_fatal)
+        await self.destroy()  # destroy twice to make sure no process left
+        self.stop_wda_proxy()
+        freeport.release_owner(self.udid)
         self._finished.set()  # no need await
 
-    def destroy(self):
-        logger.debug("terminate wda processes")
-        for p in self._procs:
-            p.terminate()
-        self._procs = []
+    async def destroy(self):
+        logger.debug("%s terminate wda processes", self)
+        if self.session_pool:
+            self.session_pool.clear()  # sessions die with wda
+        await self._supervisor.stop_all()
+
+    def terminate(self):
+        """ send SIGTERM to all processes without waiting, used when IOLoop stopped """
+        self._supervisor.terminate_all()
+
+    def process_stats(self) -> list:
+        """ start time, restarts and exit codes of every child process """
+        return self._supervisor.stats()
+
+    def _processes_changed(self):
+        registry.update(self.udid, processes=self.process_stats())
 
     async def _sleep(self, timeout: float):
         """ return false when sleep stopped by _stop(Event) """
@@ -286,32 +576,69 @@ class WDADevice(object):
         except tornado.util.TimeoutError:
             return True
 
+    async def _wait_any(self, *events, timeout: float = None):
+        """ wait until one of events is set, or timeout """
+        waits = [gen.convert_yielded(e.wait()) for e in events]
+        try:
+            await asyncio.wait(waits,
+                               timeout=timeout,
+                               return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for w in waits:
+                w.cancel()
+
     async def watch_wda_status(self):
         """
-        check WebDriverAgent all the time
+        check WebDriverAgent by health_scheduler, until wda ping fail too many times or stop() called
         """
-        # check wda_status every 30s
-        fail_cnt = 0
+        self._unhealthy.clear()
+        health_scheduler.add(self)
+        try:
+            await self._wait_any(self._stop, self._unhealthy,
+                                 self._supervisor.exited)
+        finally:
+            health_scheduler.remove(self.udid)
+
+        if self._unhealthy.is_set():
+            logger.warning("%s ping wda fail too many times, restart wda", self)
+            metrics.wda_restarts_total.inc(reason="unhealthy")
+        elif self._supervisor.exited.is_set():
+            logger.warning("%s process %s exited with code %s, restart wda", self,
+                           *self._supervisor.last_exit)
+            metrics.wda_restarts_total.inc(reason="process_exited")
+        await self.destroy()
+
+    @property
+    def session_pool(self):
+        """ wdaproxy.SessionPool, None when disabled or not in gateway mode """
+        route = self.proxy_gateway.get(self.udid) if self.proxy_gateway else None
+        return route.session_pool if route else None
+
+    @property
+    def is_active(self) -> bool:
+        """ whether client requests went through wdaproxy recently """
+        route = self.proxy_gateway.get(self.udid) if self.proxy_gateway else None
+        return bool(route) and route.is_active
+
+    async def health_probe(self) -> bool:
+        """ called by health_scheduler """
         last_ip = self.device_ip
-        while not self._stop.is_set():
-            if await self.wda_status():
-                if fail_cnt != 0:
-                    logger.info("wda ping recovered")
-                    fail_cnt = 0
-                if last_ip != self.device_ip:
-                    last_ip = self.device_ip
-                    await self._callback(self.status_ready, self.__wda_info)
-                await self._sleep(60)
-                logger.debug("%s is fine", self)
-            else:
-                fail_cnt += 1
-                logger.warning("%s wda ping error: %d", self, fail_cnt)
-                if fail_cnt > 3:
-                    logger.warning("ping wda fail too many times, restart wda")
-                    break
-                await self._sleep(10)
+        info = await self.wda_status()
+        if not info:
+            return False
+        logger.debug("%s is fine", self)
+        registry.update(self.udid, wdaStatus=info.get('value'))
+        if last_ip != self.device_ip:
+            await self._set_status(self.status_ready, self.__wda_info)
+        if self.session_pool:
+            self.session_pool.fill()  # previous fill may failed
+        return True
 
-        self.destroy()
+    def health_failed(self):
+        """ called by health_scheduler """
+        if self.session_pool:
+            self.session_pool.clear()
+        self._unhealthy.set()
 
     @property
     def device_ip(self):
@@ -323,6 +650,17 @@ class WDADevice(object):
         except IndexError:
             return None
 
+    @property
+    def launch_mode(self) -> str:
+        """ one of scheduler.DEFAULT_LAUNCH_LIMITS """
+        if self.manually_start_wda:
+            return "manual"
+        if self.use_tidevice:
+            return "tidevice"
+        if "Simulator" in self.product:
+            return "simulator"
+        return "xcodebuild"
+
     async def run_webdriveragent(self) -> bool:
         """
         UDID=$(idevice_id -l)
@@ -333,18 +671,25 @@ class WDADevice(object):
         Raises:
             RuntimeError
         """
-        if self._procs:
-            self.destroy() # hotfix
-            #raise RuntimeError("should call destroy before run_webdriveragent", self._procs)
+        await self.destroy()
+        self._supervisor.exited.clear()
 
-        async with self._lock:
-            # holding lock, because multi wda run will raise error
+        mode = self.launch_mode
+        async with self._scheduler.slot(mode, self.udid) as slot:
+            # holding slot, because multi wda run will raise error
             # Testing failed:
             #    WebDriverAgentRunner-Runner.app encountered an error (Failed to install or launch the test
             #    runner. (Underlying error: Only directories may be uploaded. Please try again with a directory
             #    containing items to upload to the application_s sandbox.))
-            self._wda_port = freeport.get()
-            self._mjpeg_port = freeport.get()
+            self.launch_wait_time = slot.wait_time
+            metrics.wda_launch_phase_seconds.observe(slot.wait_time, mode=mode, phase="lock_wait")
+            spawn_start = time.time()
+            self._launched.clear()
+            self._listening.clear()
+            self._launch_fatal.clear()
+            self.fatal_output = None
+            self._wda_port = freeport.get((self.udid, "wda"))
+            self._mjpeg_port = freeport.get((self.udid, "mjpeg"))
             cmd = [
                 'xcodebuild', '-project',
                 os.path.join(self.wda_directory, 'WebDriverAgent.xcodeproj'),
@@ -366,71 +711,193 @@ class WDADevice(object):
                 # 明确使用 tidevice 命令启动 wda
                 logger.info("Got param --use-tidevice , use tidevice to launch wda")
                 tidevice_cmd = ['tidevice', '-u', self.udid, 'xctest', '-B', self.wda_bundle_pattern]
-                self.run_background(tidevice_cmd, stdout=subprocess.DEVNULL,
-                                    stderr=subprocess.STDOUT)
+                await self._supervisor.start("launcher", tidevice_cmd,
+                                             on_output=self._on_launcher_output)
             else:
-                self.run_background(
-                    cmd, stdout=subprocess.DEVNULL,
-                    stderr=subprocess.STDOUT)  # cwd='Appium-WebDriverAgent')
+                await self._supervisor.start("launcher", cmd,
+                                             on_output=self._on_launcher_output)  # cwd='Appium-WebDriverAgent')
 
             if "Simulator" not in self.product:
-                self.run_background(
+                # relays are cheap to restart, no need to relaunch wda
+                await self._supervisor.start(
+                    "wda-relay",
                     ["tidevice", '-u', self.udid, 'relay',
                      str(self._wda_port), "8100"],
-                    silent=True)
-                self.run_background(
+                    restart=True, silent=True)  # yapf: disable
+                await self._supervisor.start(
+                    "mjpeg-relay",
                     ["tidevice", '-u', self.udid, 'relay',
                      str(self._mjpeg_port), "9100"],
-                    silent=True)
-
-            self.restart_wda_proxy()
-            return await self.wait_until_ready()
-
-    def run_background(self, *args, **kwargs):
-        if kwargs.pop("silent", False):
-            kwargs['stdout'] = subprocess.DEVNULL
-            kwargs['stderr'] = subprocess.DEVNULL
-        logger.debug("exec: %s", subprocess.list2cmdline(args[0]))
-        p = subprocess.Popen(*args, **kwargs)
-        self._procs.append(p)
-
-    def restart_wda_proxy(self):
-        if self._wda_proxy_proc:
-            self._wda_proxy_proc.terminate()
-        self._wda_proxy_port = freeport.get()
+                    restart=True, silent=True)  # yapf: disable
+
+            await self.restart_wda_proxy()
+            spawned = time.time()
+            metrics.wda_launch_phase_seconds.observe(spawned - spawn_start, mode=mode, phase="spawn")
+            ready = gen.convert_yielded(self.wait_until_ready())
+            if mode != "manual":
+                # only the install phase can not run in parallel
+                launched = gen.convert_yielded(self._launched.wait())
+                await asyncio.wait([ready, launched],
+                                   return_when=asyncio.FIRST_COMPLETED)
+                launched.cancel()
+
+        ok = await ready
+        if ok:
+            metrics.wda_launch_phase_seconds.observe(time.time() - spawned, mode=mode, phase="readiness")
+            self._scheduler.mark_healthy(self.udid)
+        return ok
+
+    def _on_launcher_output(self, line: str):
+        if LAUNCHED_RE.search(line):
+            logger.debug("%s test runner launched", self)
+            self._launched.set()
+        m = SERVER_URL_RE.search(line)
+        if m:
+            logger.debug("%s wda listening on %s", self, m.group(1))
+            self._listening.set()
+        if FATAL_RE.search(line) and not self._launch_fatal.is_set():
+            logger.error("%s launcher fatal output: %s", self, line)
+            self.fatal_output = line
+            self._launch_fatal.set()
+
+    async def restart_wda_proxy(self):
+        """ serve wdaproxy on new public and standby ports """
+        self._wda_proxy_port = freeport.get((self.udid, "proxy"))
+        self._standby_proxy_port = freeport.get((self.udid, "proxy-standby"))
+        if self.proxy_gateway:
+            logger.debug("update wdaproxy gateway with port: %d", self._wda_proxy_port)
+            self.proxy_gateway.route(self.udid, self._wda_proxy_port,
+                                     self.wda_device_url, self.mjpeg_device_url)
+            self.proxy_gateway.get(self.udid).on_active = partial(
+                health_scheduler.mark_active, self.udid)
+            self.proxy_gateway.standby(self.udid, self._standby_proxy_port)
+            return
+
         logger.debug("restart wdaproxy with port: %d", self._wda_proxy_port)
-        self._wda_proxy_proc = subprocess.Popen([
-            sys.executable, "-u", "wdaproxy-script.py", 
-            "-p", str(self._wda_proxy_port),
-            "--wda-url", "http://localhost:{}".format(self._wda_port),
-            "--mjpeg-url", "http://localhost:{}".format(self._mjpeg_port)],
-            stdout=subprocess.DEVNULL)  # yapf: disable
+        await self._start_wda_proxy("wdaproxy", self._wda_proxy_port)
+        await self._start_wda_proxy("wdaproxy-standby", self._standby_proxy_port)
+        IOLoop.current().spawn_callback(self._warm_proxy, self._standby_proxy_port)
+
+    async def _start_wda_proxy(self, name: str, port: int):
+        await self._supervisor.start(name, [
+            sys.executable, "-u", "wdaproxy-script.py",
+            "-p", str(port),
+            "--wda-url", self.wda_device_url,
+            "--mjpeg-url", self.mjpeg_device_url],
+            restart=True, stdout=subprocess.DEVNULL)  # yapf: disable
+
+    async def rotate_wda_proxy(self):
+        """
+        Change public port of wdaproxy by promoting the standby one, which is
+        already listening, then open a new standby port
+        """
+        if self._standby_proxy_port is None:
+            await self.restart_wda_proxy()
+            return
+        async with self._proxy_lock:
+            await self._wait_standby_renewal()
+            freeport.swap((self.udid, "proxy"), (self.udid, "proxy-standby"))
+            self._wda_proxy_port, self._standby_proxy_port = \
+                self._standby_proxy_port, self._wda_proxy_port
+            if self.proxy_gateway:
+                self.proxy_gateway.swap(self.udid)
+                # previous public port is released
+                self._standby_proxy_port = freeport.get((self.udid, "proxy-standby"))
+                self.proxy_gateway.standby(self.udid, self._standby_proxy_port)
+            else:
+                await self._wait_listening(self._wda_proxy_port)  # standby may be just spawned
+                self._supervisor.swap("wdaproxy", "wdaproxy-standby")
+                self._standby_renewal = gen.convert_yielded(self._renew_standby_proxy())
+        logger.debug("%s wdaproxy public port: %d", self, self._wda_proxy_port)
+
+    async def _wait_standby_renewal(self):
+        """ called with _proxy_lock held, so standby is never the port just taken away """
+        renewal, self._standby_renewal = self._standby_renewal, None
+        if renewal is not None:
+            await renewal
+
+    async def _renew_standby_proxy(self):
+        """ replace the previous public wdaproxy process with a new standby one """
+        try:
+            await self._supervisor.stop("wdaproxy-standby")
+            if not self._supervisor.get("wdaproxy").running:
+                return  # destroyed meanwhile
+            # previous public port is released
+            self._standby_proxy_port = freeport.get((self.udid, "proxy-standby"))
+            await self._start_wda_proxy("wdaproxy-standby", self._standby_proxy_port)
+            await self._warm_proxy(self._standby_proxy_port)
+        except Exception as e:
+            logger.warning("%s renew standby wdaproxy error: %s", self, e)
+
+    async def _warm_proxy(self, port: int):
+        """ first request of a new wdaproxy process is slow, make it before published """
+        if not await self._wait_listening(port, timeout=10):
+            return
+        try:
+            await httpclient.AsyncHTTPClient().fetch(
+                "http://127.0.0.1:{}/status".format(port), request_timeout=15)
+        except Exception as e:
+            logger.debug("%s warm wdaproxy error: %s", self, e)
+
+    async def _wait_listening(self, port: int, timeout: float = 5.0) -> bool:
+        deadline = time.time() + timeout
+        while True:
+            try:
+                stream = await TCPClient().connect("127.0.0.1", port)
+                stream.close()
+                return True
+            except (OSError, StreamClosedError):
+                if time.time() > deadline:
+                    logger.warning("%s port %d is not listening", self, port)
+                    return False
+                await gen.sleep(.05)
+
+    def stop_wda_proxy(self):
+        """ wdaproxy process is stopped by destroy() """
+        if self.proxy_gateway:
+            self.proxy_gateway.remove(self.udid)
 
     async def wait_until_ready(self, timeout: float = 60.0) -> bool:
         """
+        Poll wda/status with exponential backoff (0.1s up to 2s),
+        wake up at once when launcher printed ServerURLHere, fatal error or a process quit.
+
         Returns:
             bool
         """
         deadline = time.time() + timeout
-        while time.time() < deadline and not self._stop.is_set():
-            quited = any([p.poll() is not None for p in self._procs])
-            if quited:
-                logger.warning("%s process quit %s", self,
-                               [(p.pid, p.poll()) for p in self._procs])
+        delay = 0.1
+        while not self._stop.is_set():
+            if self._launch_fatal.is_set():
+                return False
+            if self._supervisor.exited.is_set():
+                logger.warning("%s process %s quit with code %s", self,
+                               *self._supervisor.last_exit)
                 return False
+            self._listening.clear()  # only one /status to confirm ServerURLHere
             if await self.wda_status():
                 return True
-            await self._sleep(1)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            await self._wait_any(self._stop, self._listening, self._launch_fatal,
+                                 self._supervisor.exited,
+                                 timeout=min(delay, remaining))
+            delay = min(delay * 2, 2.0)
         return False
 
     async def restart_wda(self):
-        self.destroy()
+        await self.destroy()
         return await self.run_webdriveragent()
 
     @property
     def wda_device_url(self):
         return "http://localhost:{}".format(self._wda_port)
 
+    @property
+    def mjpeg_device_url(self):
+        return "http://localhost:{}".format(self._mjpeg_port)
+
     async def wda_status(self):
         """
         Returns:
@@ -502,18 +969,28 @@ class WDADevice(object):
         return True
 
     async def wda_healthcheck(self):
+        """ /status, /screenshot and /wda/healthcheck are requested at the same time """
         client = httpclient.AsyncHTTPClient()
 
-        if not await self.is_wda_alive():
+        async def healthcheck():
+            try:
+                await client.fetch(self.wda_device_url + "/wda/healthcheck")
+            except Exception as e:
+                return e
+
+        session_ok, screenshot_ok, error = await gen.multi(
+            [self.wda_session_ok(), self.wda_screenshot_ok(), healthcheck()])
+        if not (session_ok and screenshot_ok):
             logger.warning("%s check failed -_-!", self)
-            await self._callback(self.status_preparing)
+            await self._set_status(self.status_preparing)
             if not await self.restart_wda():
                 logger.warning("%s wda recover in healthcheck failed", self)
                 return
-        else:
-            logger.debug("%s all check passed ^_^", self)
-
-        await client.fetch(self.wda_device_url + "/wda/healthcheck")
+            await client.fetch(self.wda_device_url + "/wda/healthcheck")
+            return
+        if error:
+            raise error
+        logger.debug("%s all check passed ^_^", self)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,65 @@
+# coding: utf-8
+#
+# Install ipa with ideviceinstaller, progress is parsed line by line
+
+import asyncio
+import re
+import time
+
+from logzero import logger
+
+import metrics
+
+# eg: "Install: CreatingStagingDirectory (5%)", "Install: Complete"
+PROGRESS_RE = re.compile(r"^(?!ERROR)(\w+): (\w+)(?: \((\d+)%\))?")
+
+
+def parse_progress(line: str) -> dict:
+    """
+    Returns:
+        dict with keys: line, and stage, status, percent when it is a progress line
+    """
+    progress = {"line": line}
+    m = PROGRESS_RE.match(line)
+    if m:
+        progress["stage"] = m.group(1)
+        progress["status"] = m.group(2)
+        if m.group(3):
+            progress["percent"] = int(m.group(3))
+    return progress
+
+
+async def install_ipa(udid: str, ipa_path: str, on_progress=None) -> dict:
+    """
+    Args:
+        on_progress: function (dict) -> None, called with parse_progress() of every output line
+
+    Returns:
+        {"success": bool, "return": exit code, "description": last status or error}
+    """
+    start = time.time()
+    p = await asyncio.create_subprocess_exec("ideviceinstaller", "-u", udid, "-i", ipa_path,
+                                             stdin=asyncio.subprocess.DEVNULL,
+                                             stdout=asyncio.subprocess.PIPE,
+                                             stderr=asyncio.subprocess.STDOUT)
+    status = None
+    error = None
+    async for raw in p.stdout:
+        line = raw.decode('utf-8', errors='replace').strip()
+        if not line:
+            continue
+        logger.debug("%s -- %s", udid[:7], line)
+        progress = parse_progress(line)
+        status = progress.get("status", status)
+        if line.startswith("ERROR"):
+            error = line
+        if on_progress:
+            on_progress(progress)
+    exit_code = await p.wait()
+    success = status == "Complete"
+    metrics.app_install_seconds.observe(time.time() - start, result="ok" if success else "fail")
+    return {
+        "success": success,
+        "return": exit_code,
+        "description": error or status,
+    }
@@ -0,0 +1,257 @@
+# coding: utf-8
+#
+# Downloaded ipa files, stored by sha256 of their content
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+
+import requests
+from logzero import logger
+
+import metrics
+from downloader import RangeDownloader
+
+IPA_CACHE_DIR = os.path.expanduser("~/.atxserver2-ios-provider/ipa-cache")
+
+
+class IPACache(object):
+    """
+    Every url is downloaded again only when its ETag or Last-Modified changed,
+    checked by a conditional GET. Files are named <sha256>.ipa, so urls with the
+    same content share one file. Least recently used files are removed when the
+    total size is over max_bytes. Large files are downloaded by RangeDownloader,
+    interrupted downloads are resumed by the next fetch.
+
+    Concurrent fetch of the same url share one download.
+
+    Example usage:
+
+    ipa_path = ipa_cache.fetch(url)
+    try:
+        install(ipa_path)
+    finally:
+        ipa_cache.release(ipa_path)
+    """
+
+    def __init__(self,
+                 cache_dir: str = IPA_CACHE_DIR,
+                 max_bytes: int = 4 << 30,
+                 downloader: RangeDownloader = None):
+        self._cache_dir = cache_dir
+        self._downloader = downloader or RangeDownloader()
+        self._index_path = os.path.join(cache_dir, "index.json")
+        self._max_bytes = max_bytes
+        self._mutex = threading.Lock()
+        self._index = {}  # url -> {"sha256", "size", "etag", "lastModified", "atime"}
+        self._inflight = {}  # url -> Future
+        self._refs = defaultdict(int)  # sha256 -> using count
+        self._verified = set()  # sha256 checked since loaded
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.bytes_downloaded = 0
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self._index_path, "r", encoding="utf-8") as f:
+                self._index = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning("load ipa cache index %s error: %s", self._index_path, e)
+
+    def _save(self):
+        try:
+            tmp_path = self._index_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._index, f, indent=4)
+            os.replace(tmp_path, self._index_path)
+        except OSError as e:
+            logger.warning("save ipa cache index %s error: %s", self._index_path, e)
+
+    def _path(self, sha256: str) -> str:
+        return os.path.join(self._cache_dir, sha256 + ".ipa")
+
+    def stats(self) -> dict:
+        with self._mutex:
+            shas = {e['sha256']: e['size'] for e in self._index.values()}
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "bytesSaved": self.bytes_saved,
+                "bytesDownloaded": self.bytes_downloaded,
+                "files": len(shas),
+                "totalBytes": sum(shas.values()),
+                "maxBytes": self._max_bytes,
+                "downloading": len(self._inflight),
+            }
+
+    def fetch(self, url: str, sha256: str = None, info: dict = None) -> str:
+        """
+        Download url if not cached, blocking, should run in executor
+
+        Args:
+            sha256: expected sha256 of the ipa
+            info: filled with "cache": hit, miss or shared, and "download": RangeDownloader stats
+
+        Returns:
+            ipa path, which is kept until release(ipa_path) called
+
+        Raises:
+            requests.RequestException, IOError
+        """
+        start = time.time()
+        with self._mutex:
+            future = self._inflight.get(url)
+            leader = future is None
+            if leader:
+                future = self._inflight[url] = Future()
+
+        if leader:
+            try:
+                entry, stats = self._fetch(url)
+                future.set_result((entry, stats))
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            finally:
+                with self._mutex:
+                    del self._inflight[url]
+        else:
+            logger.debug("wait for downloading %s", url)
+            entry, stats = future.result()
+            stats = dict(stats, cache="shared")
+            with self._mutex:
+                self.hits += 1
+                self.bytes_saved += entry['size']
+        metrics.ipa_download_seconds.observe(time.time() - start, cache=stats['cache'])
+        if info is not None:
+            info.update(stats)
+
+        if sha256 and entry['sha256'] != sha256.lower():
+            raise IOError("sha256 mismatch, expect {} got {}".format(
+                sha256, entry['sha256']))
+        with self._mutex:
+            self._refs[entry['sha256']] += 1
+        return self._path(entry['sha256'])
+
+    def release(self, ipa_path: str):
+        sha256 = os.path.basename(ipa_path)[:-len(".ipa")]
+        with self._mutex:
+            self._refs[sha256] -= 1
+            if self._refs[sha256] <= 0:
+                del self._refs[sha256]
+
+    def _fetch(self, url: str) -> dict:
+        headers = {}
+        cached = self._index.get(url)
+        if cached and self._verify(cached['sha256']):
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('lastModified'):
+                headers['If-Modified-Since'] = cached['lastModified']
+
+        with requests.get(url, headers=headers, stream=True, timeout=30) as r:
+            etag = r.headers.get("ETag")
+            last_modified = r.headers.get("Last-Modified")
+            # no validators: can not tell whether content changed
+            not_modified = headers and (r.status_code == 304 or (
+                r.status_code == 200 and (etag or last_modified) and
+                (etag, last_modified) == (cached.get('etag'), cached.get('lastModified'))))
+            if not_modified:
+                logger.debug("ipa cache hit: %s", url)
+                with self._mutex:
+                    cached['atime'] = time.time()
+                    self.hits += 1
+                    self.bytes_saved += cached['size']
+                    self._save()
+                return cached, {"cache": "hit"}
+
+            r.raise_for_status()
+            os.makedirs(self._cache_dir, exist_ok=True)
+            partial_path = self._partial_path(url)
+            try:
+                download = self._downloader.download(url, partial_path, response=r)
+            except BaseException:
+                if not os.path.exists(partial_path + ".json"):  # can not resume
+                    if os.path.exists(partial_path):
+                        os.unlink(partial_path)
+                raise
+            logger.info("ipa downloaded: %s %s", url, download)
+            sha256 = self._store(partial_path)
+            size = download['bytes']
+
+        entry = {
+            "sha256": sha256,
+            "size": size,
+            "etag": etag,
+            "lastModified": last_modified,
+            "atime": time.time(),
+        }
+        with self._mutex:
+            self._index[url] = entry
+            self.misses += 1
+            self.bytes_downloaded += size
+            self._evict(keep=sha256)
+            self._save()
+        return entry, {"cache": "miss", "download": download}
+
+    def _partial_path(self, url: str) -> str:
+        return os.path.join(self._cache_dir,
+                            "partial-" + hashlib.sha1(url.encode()).hexdigest() + ".ipa")
+
+    def _store(self, partial_path: str) -> str:
+        """ move downloaded file to <sha256>.ipa, return sha256 """
+        sha256 = self._hash_file(partial_path)
+        os.replace(partial_path, self._path(sha256))
+        with self._mutex:
+            self._verified.add(sha256)
+        return sha256
+
+    def _hash_file(self, path: str) -> str:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def _verify(self, sha256: str) -> bool:
+        """ check file content once after loaded from disk """
+        if sha256 in self._verified:
+            return os.path.isfile(self._path(sha256))
+        try:
+            if self._hash_file(self._path(sha256)) != sha256:
+                logger.warning("ipa cache %s is corrupted", sha256)
+                return False
+        except OSError:
+            return False
+        with self._mutex:
+            self._verified.add(sha256)
+        return True
+
+    def _evict(self, keep: str):
+        """ remove least recently used files, called with mutex held """
+        sizes = {e['sha256']: e['size'] for e in self._index.values()}
+        total = sum(sizes.values())
+        for url, entry in sorted(self._index.items(), key=lambda kv: kv[1]['atime']):
+            if total <= self._max_bytes:
+                break
+            sha256 = entry['sha256']
+            if sha256 == keep or sha256 in self._refs:
+                continue
+            del self._index[url]
+            if any(e['sha256'] == sha256 for e in self._index.values()):
+                continue  # file shared with other urls
+            total -= sizes[sha256]
+            self._verified.discard(sha256)
+            try:
+                os.unlink(self._path(sha256))
+            except OSError as e:
+                logger.warning("remove ipa cache %s error: %s", sha256, e)
+            logger.debug("ipa cache evicted: %s", url)
@@ -1,16 +1,14 @@
 from __future__ import print_function
 
 import argparse
+import json
 import os
-import shutil
 import subprocess
-import tempfile
 import time
 from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
-import requests
 import tornado.web
 from logzero import logger
 from tornado import gen, httpclient, locks
@@ -21,11 +19,24 @@ from tornado.log import enable_pretty_logging
 
 import heartbeat
 import idb
-from utils import current_ip
+import metrics
+from freeport import freeport
+from downloader import RangeDownloader
+from installer import install_ipa
+from ipacache import IPA_CACHE_DIR, IPACache
+import wdaproxy
+from scheduler import DEFAULT_LAUNCH_LIMITS, LaunchScheduler, health_scheduler, parse_launch_limits
+from network import NetworkIdentity
+from registry import registry
+from simctl import simctl
 from typing import Union
 
-idevices = {}
 hbc = None
+proxy_gateway = None
+launch_scheduler = None
+ipa_cache = None
+install_semaphore = None  # limit concurrent ideviceinstaller of bulk install
+network = None
 
 
 class CorsMixin(object):
@@ -71,14 +82,19 @@ class ColdingHandler(tornado.web.RequestHandler):
     async def post(self, udid=None):
         udid = udid or self.get_argument('udid', None)
         assert udid
-        d = idevices.get(udid)
+        d = registry.device(udid)
+        start = time.time()
         try:
             if not d:
                 raise Exception("Device not found")
+            launch_scheduler.mark_requested(udid)
 
-            d.restart_wda_proxy() # change wda public port
-            wda_url = "http://{}:{}".format(current_ip(), d.public_port)
+            await d.rotate_wda_proxy()  # change wda public port
+            wda_url = "http://{}:{}".format(network.ip, d.public_port)
+            registry.update(udid, wdaUrl=wda_url, ports=d.ports)
             await d.wda_healthcheck()
+            if d.session_pool:
+                d.session_pool.release()  # session of the previous user is abandoned
             await hbc.device_update({
                 "udid": udid,
                 "colding": False,
@@ -90,8 +106,10 @@ class ColdingHandler(tornado.web.RequestHandler):
                 "success": True,
                 "description": "Device successfully colded"
             })
+            metrics.cold_seconds.observe(time.time() - start, result="ok")
         except Exception as e:
             logger.warning("colding procedure got error: %s", e)
+            metrics.cold_seconds.observe(time.time() - start, result="fail")
             self.set_status(400)  # bad request
             self.write({
                 "success": False,
@@ -103,31 +121,18 @@ class AppInstallHandler(CorsMixin, tornado.web.RequestHandler):
     executor = ThreadPoolExecutor(4)
 
     @run_on_executor(executor='executor')
-    def app_install(self, udid: str, url: str):
+    def app_install(self, udid: str, url: str, sha256: str = None):
+        logger.debug("%s app-install from %s", udid[:7], url)
+        start = time.time()
+        download = {}
         try:
-            r = requests.get(url, stream=True)
-            if r.status_code != 200:
-                return {"success": False, "description": r.reason}
+            ipa_path = ipa_cache.fetch(url, sha256, info=download)
         except Exception as e:
             return {"success": False, "description": str(e)}
+        download_seconds = time.time() - start
 
-        # tempfile.
-        logger.debug("%s app-install from %s", udid[:7], url)
-        tfile = tempfile.NamedTemporaryFile(suffix=".ipa",
-                                            prefix="tmpfile-",
-                                            dir=os.getcwd())
         try:
-            ipa_path = tfile.name
-            logger.debug("%s temp ipa path: %s", udid[:7], ipa_path)
-            # try:
-            # with open(ipa_path, "wb") as tfile:
-            content_length = int(r.headers.get("content-length", 0))
-            if content_length:
-                for chunk in r.iter_content(chunk_size=40960):
-                    tfile.write(chunk)
-            else:
-                shutil.copyfileobj(r.raw, tfile)
-
+            logger.debug("%s cached ipa path: %s", udid[:7], ipa_path)
             p = subprocess.Popen(
                 ["ideviceinstaller", "-u", udid, "-i", ipa_path],
                 stdout=subprocess.PIPE,
@@ -139,6 +144,8 @@ class AppInstallHandler(CorsMixin, tornado.web.RequestHandler):
                 output += line
             success = "Complete" in output
             exit_code = p.wait()
+            metrics.app_install_seconds.observe(time.time() - start - download_seconds,
+                                                result="ok" if success else "fail")
 
             if not success:
                 return {"success": False, "description": output}
@@ -146,37 +153,194 @@ class AppInstallHandler(CorsMixin, tornado.web.RequestHandler):
                 "success": success,
                 # "bundleId": bundle_id,
                 "return": exit_code,
-                "output": output
+                "output": output,
+                "download": download,
+                "downloadSeconds": round(download_seconds, 3),
+                "installSeconds": round(time.time() - start - download_seconds, 3),
             }
         except Exception as e:
             return {"success": False, "status": 500, "description": str(e)}
         finally:
-            tfile.close()
+            ipa_cache.release(ipa_path)
 
     @gen.coroutine
     def post(self):
         udid = self.get_argument("udid")
         url = self.get_argument("url")
-        device = idevices[udid]
-        ret = yield self.app_install(device.udid, url)
+        sha256 = self.get_argument("sha256", None)
+        device = registry.device(udid)
+        launch_scheduler.mark_requested(udid)
+        ret = yield self.app_install(device.udid, url, sha256)
         if not ret['success']:
             self.set_status(ret.get("status", 400))  # default bad request
         self.write(ret)
 
 
-def make_app(**settings):
+class AppBulkInstallHandler(CorsMixin, tornado.web.RequestHandler):
+    """
+    Download ipa once, install to many devices, progress is streamed as json lines
+
+    Request body (json or form):
+        url: ipa url
+        sha256: (optional) expected sha256 of ipa
+        udids: list of udid, form field: udid (repeatable)
+        filter: (used when udids is empty) eg: {"product": "iPhone 1*", "status": "ready"},
+            glob patterns of fields of GET /devices records, form field is json string
+
+    Response lines:
+        {"event": "download", "url": ..., "udids": [...]}
+        {"event": "downloaded", "cache": "hit|miss|shared", "seconds": ..., "download": {...}}
+        {"event": "progress", "udid": ..., "line": ..., "status": ..., "percent": ...}
+        {"event": "result", "udid": ..., "success": ..., ...}
+        {"event": "done", "success": ..., "succeeded": N, "failed": N}
+    """
+
+    def prepare(self):
+        self._closed = False
+
+    def on_connection_close(self):
+        self._closed = True
+
+    def _params(self) -> dict:
+        if self.request.headers.get("Content-Type", "").startswith("application/json"):
+            return json.loads(self.request.body)
+        params = {
+            "url": self.get_argument("url"),
+            "sha256": self.get_argument("sha256", None),
+            "udids": self.get_arguments("udid"),
+        }
+        if self.get_argument("filter", None):
+            params["filter"] = json.loads(self.get_argument("filter"))
+        return params
+
+    def _select_udids(self, params: dict) -> list:
+        if params.get("udids"):
+            return params["udids"]
+        filters = params.get("filter") or {}
+        return [record['udid'] for record in registry.query(**filters)]
+
+    def emit(self, data: dict):
+        if self._closed:  # keep installing, but nobody listens
+            return
+        self.write(json.dumps(data) + "\n")
+        self.flush()
+
+    async def post(self):
+        try:
+            params = self._params()
+            url = params["url"]
+        except (KeyError, ValueError, tornado.web.MissingArgumentError) as e:
+            raise tornado.web.HTTPError(400, "invalid params: %s" % e)
+        udids = self._select_udids(params)
+        if not udids:
+            raise tornado.web.HTTPError(400, "no device selected")
+
+        self.set_header("Content-Type", "application/x-ndjson")
+        self.emit({"event": "download", "url": url, "udids": udids})
+        start = time.time()
+        download = {}
+        try:
+            ipa_path = await IOLoop.current().run_in_executor(
+                None, partial(ipa_cache.fetch, url, params.get("sha256"), info=download))
+        except Exception as e:
+            self.emit({"event": "done", "success": False, "description": str(e)})
+            return
+        self.emit(dict(download, event="downloaded",
+                       seconds=round(time.time() - start, 3)))  # yapf: disable
+
+        try:
+            results = await gen.multi([self._install(udid, ipa_path) for udid in udids])
+        finally:
+            ipa_cache.release(ipa_path)
+        succeeded = sum(1 for ok in results if ok)
+        self.emit({
+            "event": "done",
+            "success": succeeded == len(udids),
+            "succeeded": succeeded,
+            "failed": len(udids) - succeeded,
+        })
+
+    async def _install(self, udid: str, ipa_path: str) -> bool:
+        if udid not in registry:
+            self.emit({"event": "result", "udid": udid, "success": False,
+                       "description": "device not found"})  # yapf: disable
+            return False
+        launch_scheduler.mark_requested(udid)
+        async with install_semaphore:
+            self.emit({"event": "progress", "udid": udid, "status": "Started"})
+            start = time.time()
+            try:
+                ret = await install_ipa(
+                    udid, ipa_path,
+                    on_progress=lambda p: self.emit(dict(p, event="progress", udid=udid)))
+            except Exception as e:
+                ret = {"success": False, "description": str(e)}
+            ret["installSeconds"] = round(time.time() - start, 3)
+        self.emit(dict(ret, event="result", udid=udid))
+        return ret["success"]
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """ prometheus text format """
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.registry.render())
+
+
+class DevicesHandler(CorsMixin, tornado.web.RequestHandler):
+    """
+    Devices of this provider, filtered by glob patterns of record fields, eg:
+    GET /devices?status=ready&product=iPhone%2012&version=15.*
+
+    Repeated arguments match any of them. The ETag changes whenever any device
+    changes, so polling with If-None-Match is answered by 304 without a body.
+    """
+
+    def compute_etag(self):
+        return registry.etag
+
+    def get(self):
+        self.set_etag_header()
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        filters = {
+            name: self.get_arguments(name)
+            for name in self.request.query_arguments
+        }
+        devices = registry.query(**filters)
+        self.write({"count": len(devices), "devices": devices})
+
+
+class AppCacheHandler(tornado.web.RequestHandler):
+    """ ipa download cache statistics """
+
+    def get(self):
+        self.write(ipa_cache.stats())
+
+
+def make_app(gateway: wdaproxy.WDAProxyGateway = None, **settings):
     settings['template_path'] = 'templates'
     settings['static_path'] = 'static'
     settings['cookie_secret'] = os.environ.get("SECRET", "SECRET:_")
     settings['login_url'] = '/login'
-    return tornado.web.Application([
+    handlers = [
         (r"/", MainHandler),
         (r"/testerhome", ProxyTesterhomeHandler),
         (r"/devices/([^/]+)/cold", ColdingHandler),
         (r"/devices/([^/]+)/app/install", AppInstallHandler),
         (r"/cold", ColdingHandler),
         (r"/app/install", AppInstallHandler),
-    ], **settings)
+        (r"/app/install/bulk", AppBulkInstallHandler),
+        (r"/app/cache", AppCacheHandler),
+        (r"/devices/?", DevicesHandler),
+        (r"/metrics", MetricsHandler),
+    ]
+    if gateway:
+        # /devices/<udid>/... proxy to wda, must be the last ones
+        handlers.extend(gateway.handlers())
+    return tornado.web.Application(handlers, **settings)
 
 
 async def _device_callback(d: idb.WDADevice,
@@ -185,6 +349,7 @@ async def _device_callback(d: idb.WDADevice,
     """ monitor device status """
     wd = idb.WDADevice
 
+    registry.update(d.udid, status=status)
     if status == wd.status_preparing:
         await hbc.device_update({
             "udid": d.udid,
@@ -201,12 +366,21 @@ async def _device_callback(d: idb.WDADevice,
 
         assert isinstance(info, dict)
         info = defaultdict(dict, info)
+        wda_url = "http://{}:{}".format(network.ip, d.public_port)
+        registry.update(d.udid,
+                        ip=info['value']['ios']['ip'],
+                        version=info['value']['os']['version'],
+                        sdkVersion=info['value']['os']['sdkVersion'],
+                        wdaUrl=wda_url,
+                        ports=d.ports,
+                        launchWaitTime=round(d.launch_wait_time, 3),
+                        wdaStatus=info['value'])
 
         await hbc.device_update({
             # "colding": False,
             "udid": d.udid,
             "provider": {
-                "wdaUrl": "http://{}:{}".format(current_ip(), d.public_port)
+                "wdaUrl": wda_url
             },
             "properties": {
                 "ip": info['value']['ios']['ip'],
@@ -215,6 +389,7 @@ async def _device_callback(d: idb.WDADevice,
             }
         })  # yapf: disable
     elif status == wd.status_fatal:
+        registry.update(d.udid, wdaUrl=None)
         await hbc.device_update({
             "udid": d.udid,
             "provider": None,
@@ -223,28 +398,54 @@ async def _device_callback(d: idb.WDADevice,
         logger.error("Unknown status: %s", status)
 
 
-async def device_watch(wda_directory: str, manually_start_wda: bool, use_tidevice: bool, wda_bundle_pattern: bool):
+def _device_status_counts() -> dict:
+    return {(status, ): count for status, count in registry.counts("status").items()}
+
+
+async def _ip_changed(port: int, old_ip: str, new_ip: str):
+    """ publish new wdaUrl of all ready devices at once """
+    hbc.update_provider_url("http://{}:{}".format(new_ip, port))
+    for d in registry.devices():
+        if d.status == idb.WDADevice.status_ready and d.public_port:
+            wda_url = "http://{}:{}".format(new_ip, d.public_port)
+            registry.update(d.udid, wdaUrl=wda_url)
+            await hbc.device_update({
+                "udid": d.udid,
+                "provider": {
+                    "wdaUrl": wda_url
+                },
+            })
+
+
+async def device_watch(wda_directory: str, manually_start_wda: bool, use_tidevice: bool, wda_bundle_pattern: bool,
+                       track_mode: str = "listen"):
     """
     When iOS device plugin, launch WDA
     """
-    lock = locks.Lock()  # WDA launch one by one
 
-    async for event in idb.track_devices():
+    stale_info = set()  # udids of devices unplugged after wda failed, eg: renamed or upgraded
+    async for event in idb.track_devices(listen=(track_mode == "listen")):
         if event.udid.startswith("ffffffffffffffffff"):
             logger.debug("Invalid event: %s", event)
             continue
         logger.debug("Event: %s", event)
         if event.present:
-            d = idb.WDADevice(event.udid, lock=lock, callback=_device_callback)
+            d = idb.WDADevice(event.udid, scheduler=launch_scheduler, callback=_device_callback,
+                              refresh_info=event.udid in stale_info)
+            stale_info.discard(event.udid)
             d.wda_directory = wda_directory
             d.manually_start_wda = manually_start_wda
             d.use_tidevice = use_tidevice
             d.wda_bundle_pattern = wda_bundle_pattern
-            idevices[event.udid] = d
+            d.proxy_gateway = proxy_gateway
+            registry.add(d)
             d.start()
         else:  # offline
-            await idevices[event.udid].stop()
-            idevices.pop(event.udid)
+            d = registry.device(event.udid)
+            if d.status == idb.WDADevice.status_fatal:
+                stale_info.add(event.udid)  # re-plug refreshes lockdown values
+            await d.stop()
+            registry.remove(event.udid)
 
 
 async def async_main():
@@ -280,23 +481,157 @@ async def async_main():
                         default="*WebDriverAgent*",
                         required=False,
                         help="If using --use-tidevice, can override wda bundle name pattern manually")
+    parser.add_argument("--wdaproxy-mode",
+                        choices=["gateway", "process"],
+                        default="gateway",
+                        help="gateway: proxy all devices inside provider, process: one wdaproxy-script.py per device")
+    parser.add_argument("--wdaproxy-pool-size",
+                        type=int,
+                        default=8,
+                        help="max connections from wdaproxy gateway to every wda")
+    parser.add_argument("--wdaproxy-pool-idle-timeout",
+                        type=float,
+                        default=30.0,
+                        help="seconds to keep idle connections from wdaproxy gateway to wda")
+    parser.add_argument("--wdaproxy-screenshot-ttl",
+                        type=float,
+                        default=0.3,
+                        help="seconds to reuse wda /screenshot result in wdaproxy gateway, 0 to only coalesce")
+    parser.add_argument("--wdaproxy-screenshot-from-mjpeg",
+                        action="store_true",
+                        help="answer /screenshot with the latest mjpeg frame when screen is being watched")
+    parser.add_argument("--wdaproxy-response-cache",
+                        action="store_true",
+                        help="cache idempotent wda GET like /source in wdaproxy gateway, dropped on any POST or DELETE")
+    parser.add_argument("--wdaproxy-response-cache-max-bytes",
+                        type=int,
+                        default=32 << 20,
+                        help="max body bytes kept in response cache of every device")
+    parser.add_argument("--wdaproxy-response-cache-ttl",
+                        action="append",
+                        metavar="NAME=SECONDS",
+                        help="override cache ttl, NAME is one of: " + ", ".join(wdaproxy.CACHEABLE_ENDPOINTS))
+    parser.add_argument("--wdaproxy-session-pool",
+                        action="store_true",
+                        help="keep a pre-created wda session of every ready device, "
+                        "answer POST /session without capabilities in wdaproxy gateway")
+    parser.add_argument("--heartbeat-flush-interval",
+                        type=float,
+                        default=0.5,
+                        help="seconds to merge device updates before sending to server")
+    parser.add_argument("--launch-limit",
+                        action="append",
+                        metavar="MODE=N",
+                        help="max concurrent wda launches, MODE is one of: " + ", ".join(DEFAULT_LAUNCH_LIMITS))
+    parser.add_argument("--port-lock-dir",
+                        help="lock file directory to avoid port conflicts between providers on the same host")
+    parser.add_argument("--track-mode",
+                        choices=["listen", "poll"],
+                        default="listen",
+                        help="listen: subscribe usbmuxd device events, poll: list devices every second")
+    parser.add_argument("--simctl-max-age",
+                        type=float,
+                        default=10.0,
+                        help="seconds to reuse simctl list devices result")
+    parser.add_argument("--xcrun",
+                        default="xcrun",
+                        help="xcrun executable used to list simulators")
+    parser.add_argument("--ipa-cache-dir",
+                        default=IPA_CACHE_DIR,
+                        help="directory to keep downloaded ipa files")
+    parser.add_argument("--ipa-cache-max-bytes",
+                        type=int,
+                        default=4 << 30,
+                        help="max total size of cached ipa files")
+    parser.add_argument("--ipa-download-segments",
+                        type=int,
+                        default=4,
+                        help="parallel range requests to download a large ipa")
+    parser.add_argument("--install-concurrency",
+                        type=int,
+                        default=4,
+                        help="max concurrent app installs of /app/install/bulk")
+    parser.add_argument("--advertise-ip",
+                        help="ip in wdaUrl and provider url, default is the address of default route")
+    parser.add_argument("--advertise-interface",
+                        help="use ip of this network interface, eg: en0")
+    parser.add_argument("--ip-poll-interval",
+                        type=float,
+                        default=10.0,
+                        help="seconds between checks of ip change")
+    parser.add_argument("--health-interval",
+                        type=float,
+                        default=60.0,
+                        help="seconds between wda health probes, doubled after every 5 passes")
+    parser.add_argument("--health-max-interval",
+                        type=float,
+                        default=300.0,
+                        help="max seconds between wda health probes of stable devices")
+    parser.add_argument("--health-max-inflight",
+                        type=int,
+                        default=4,
+                        help="max concurrent wda health probes")
 
 
     args = parser.parse_args()
 
+    if args.port_lock_dir:
+        freeport.enable_lock_dir(args.port_lock_dir)
+
+    simctl.xcrun = args.xcrun
+    simctl.max_age = args.simctl_max_age
+
+    global launch_scheduler
+    launch_scheduler = LaunchScheduler(parse_launch_limits(args.launch_limit))
+    health_scheduler.configure(interval=args.health_interval,
+                               max_interval=args.health_max_interval,
+                               max_inflight=args.health_max_inflight)
+
+    global ipa_cache
+    ipa_cache = IPACache(args.ipa_cache_dir, args.ipa_cache_max_bytes,
+                         RangeDownloader(segments=args.ipa_download_segments))
+    global install_semaphore
+    install_semaphore = locks.Semaphore(args.install_concurrency)
+
+    global proxy_gateway
+    if args.wdaproxy_mode == "gateway":
+        proxy_gateway = wdaproxy.WDAProxyGateway(
+            pool_size=args.wdaproxy_pool_size,
+            pool_idle_timeout=args.wdaproxy_pool_idle_timeout,
+            screenshot_ttl=args.wdaproxy_screenshot_ttl,
+            screenshot_from_mjpeg=args.wdaproxy_screenshot_from_mjpeg,
+            response_cache=args.wdaproxy_response_cache,
+            response_cache_max_bytes=args.wdaproxy_response_cache_max_bytes,
+            response_cache_ttls=wdaproxy.parse_cache_ttls(args.wdaproxy_response_cache_ttl),
+            session_pool=args.wdaproxy_session_pool)
+
     # start server
     enable_pretty_logging()
-    app = make_app(debug=args.debug)
+    app = make_app(proxy_gateway, debug=args.debug)
     app.listen(args.port)
 
+    global network
+    network = NetworkIdentity(address=args.advertise_ip,
+                              interface=args.advertise_interface,
+                              poll_interval=args.ip_poll_interval)
+    network.add_listener(partial(_ip_changed, args.port))
+    IOLoop.current().spawn_callback(network.watch)
+    logger.info("advertised ip: %s", network.ip)
+
     global hbc
-    self_url = "http://{}:{}".format(current_ip(), args.port)
+    self_url = "http://{}:{}".format(network.ip, args.port)
     server_addr = args.server.replace("http://", "").replace("/", "")
     hbc = await heartbeat.heartbeat_connect(server_addr,
                                             platform='apple',
-                                            self_url=self_url)
+                                            self_url=self_url,
+                                            flush_interval=args.heartbeat_flush_interval)
+
+    metrics.heartbeat_queue_depth.set_function(hbc.queue_size)
+    metrics.devices.set_function(_device_status_counts)
+    metrics.wda_launch_queue_depth.set_function(launch_scheduler.queue_sizes)
 
-    await device_watch(args.wda_directory, args.manually_start_wda, args.use_tidevice, args.wda_bundle_pattern)
+    await device_watch(args.wda_directory, args.manually_start_wda, args.use_tidevice, args.wda_bundle_pattern,
+                       args.track_mode)
 
 
 if __name__ == "__main__":
@@ -305,5 +640,5 @@ if __name__ == "__main__":
         # IOLoop.instance().start()
     except KeyboardInterrupt:
         IOLoop.instance().stop()
-        for d in idevices.values():
-            d.destroy()
+        for d in registry.devices():
+            d.terminate()
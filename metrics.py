@@ -0,0 +1,163 @@
+# coding: utf-8
+#
+# In-process metrics, rendered in prometheus text format by /metrics
+
+import bisect
+import threading
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    items = ['{}="{}"'.format(n, _escape(v)) for n, v in zip(names, values)]
+    if extra:
+        items.append(extra)
+    return "{" + ",".join(items) + "}" if items else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.documentation))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class _Metric(object):
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), registry=registry):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # label values -> value
+        self._lock = threading.Lock()  # ipa download runs in threads
+        registry.register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(n, "") for n in self.labelnames)
+
+    def render(self) -> list:
+        return [
+            "{}{} {}".format(self.name, _format_labels(self.labelnames, key), _format_value(v))
+            for key, v in sorted(self._values.items())
+        ]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not self.labelnames:
+            self._values[()] = 0
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """ value is set directly, or collected by function when rendered """
+    type = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._function = None
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def set_function(self, fn):
+        """
+        Args:
+            fn: function () -> float, or dict of {label values tuple: float} when gauge has labels
+        """
+        self._function = fn
+
+    def render(self) -> list:
+        if self._function:
+            value = self._function()
+            self._values = value if isinstance(value, dict) else {(): value}
+        return super().render()
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, *args, buckets=DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._buckets = tuple(sorted(buckets)) + (float("inf"), )
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * len(self._buckets) + [0.0]  # last is sum
+            counts[i] += 1
+            counts[-1] += value
+
+    def render(self) -> list:
+        lines = []
+        for key, counts in sorted(self._values.items()):
+            total = 0
+            for bound, count in zip(self._buckets, counts):
+                total += count
+                labels = _format_labels(self.labelnames, key,
+                                        'le="{}"'.format(_format_value(bound)))
+                lines.append("{}_bucket{} {}".format(self.name, labels, total))
+            labels = _format_labels(self.labelnames, key)
+            lines.append("{}_sum{} {}".format(self.name, labels, _format_value(counts[-1])))
+            lines.append("{}_count{} {}".format(self.name, labels, total))
+        return lines
+
+
+wda_launch_phase_seconds = Histogram(
+    "wda_launch_phase_seconds",
+    "WDA launch duration by phase: lock_wait, spawn, readiness",
+    ["mode", "phase"])
+wda_health_probe_seconds = Histogram(
+    "wda_health_probe_seconds", "WDA health probe latency", ["result"])
+wda_restarts_total = Counter(
+    "wda_restarts_total", "WDA relaunches by reason", ["reason"])
+wda_fatal_total = Counter(
+    "wda_fatal_total", "devices which gave up launching WDA")
+process_restarts_total = Counter(
+    "process_restarts_total", "restarts of supervised child processes", ["name"])
+cold_seconds = Histogram(
+    "cold_seconds", "POST /cold response time", ["result"])
+app_install_seconds = Histogram(
+    "app_install_seconds", "ideviceinstaller duration", ["result"])
+ipa_download_seconds = Histogram(
+    "ipa_download_seconds", "ipa fetch duration, including cache lookup", ["cache"])
+devices = Gauge("devices", "devices by wda status", ["status"])
+wda_launch_queue_depth = Gauge(
+    "wda_launch_queue_depth", "devices waiting for a WDA launch slot", ["mode"])
+heartbeat_queue_depth = Gauge(
+    "heartbeat_queue_depth", "device updates waiting to be sent to server")
@@ -0,0 +1,249 @@
+# coding: utf-8
+#
+# MJPEG stream reading and sharing, used by wdaproxy
+
+import re
+import socket
+import urllib.request
+
+import tornado.ioloop
+from logzero import logger
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.queues import Queue
+
+
+_CONTENT_LENGTH_RE = re.compile(rb"content-length[ \t]*:[ \t]*(\d+)", re.I)
+
+
+class MjpegParser():
+    """
+    Incremental parser of multipart/x-mixed-replace body (after the HTTP response header)
+
+    Data is read straight into one big receive buffer (get_buffer), boundaries and part headers
+    are searched inside it without splitting lines, headers are matched in any case.
+    When part has no Content-Length, frame ends at the next boundary.
+
+    Example usage:
+
+    parser = MjpegParser()
+    n = await stream.read_into(parser.get_buffer(), partial=True)
+    for frame in parser.feed(n):
+        ...
+    """
+    def __init__(self, buffer_size: int = 1 << 18):
+        self._buf = bytearray(buffer_size)
+        self._start = 0  # parse position
+        self._end = 0  # end of received data
+        self._delimiter = None  # eg: b"--BoundaryString", learned from the first part
+        self._body_start = None  # not None when part header is parsed
+        self._body_end = None  # None when no Content-Length
+        self._scan_from = 0  # where to continue searching for delimiter
+
+    def get_buffer(self, min_free: int = 65536) -> memoryview:
+        """ return writable free space at the end of receive buffer """
+        if len(self._buf) - self._end < min_free:
+            self._compact(min_free)
+        return memoryview(self._buf)[self._end:]
+
+    def _compact(self, min_free: int):
+        offset = self._start
+        size = self._end - offset
+        if size + min_free > len(self._buf):
+            buf = bytearray(max(2 * len(self._buf), size + min_free))
+            buf[:size] = memoryview(self._buf)[offset:self._end]
+            self._buf = buf
+        else:
+            view = memoryview(self._buf)
+            view[:size] = view[offset:self._end]
+        self._start -= offset
+        self._end -= offset
+        self._scan_from = max(0, self._scan_from - offset)
+        if self._body_start is not None:
+            self._body_start -= offset
+        if self._body_end is not None:
+            self._body_end -= offset
+
+    def feed(self, n: int) -> list:
+        """
+        Args:
+            n: number of bytes written into get_buffer()
+
+        Returns:
+            list of complete frames (bytes)
+        """
+        self._end += n
+        frames = []
+        while True:
+            frame = self._next_frame()
+            if frame is None:
+                return frames
+            frames.append(frame)
+
+    def _parse_header(self) -> bool:
+        buf = self._buf
+        while self._start < self._end and buf[self._start] in b"\r\n":
+            self._start += 1
+        header_end = buf.find(b"\r\n\r\n", self._start, self._end)
+        if header_end == -1:
+            return False
+        if self._delimiter is None:
+            line_end = buf.find(b"\r\n", self._start, header_end + 2)
+            line = bytes(buf[self._start:line_end]).strip()
+            if line.startswith(b"--"):
+                self._delimiter = b"\r\n" + line
+        m = _CONTENT_LENGTH_RE.search(buf, self._start, header_end)
+        self._body_start = self._scan_from = header_end + 4
+        self._body_end = self._body_start + int(m.group(1)) if m else None
+        return True
+
+    def _next_frame(self):
+        if self._body_start is None and not self._parse_header():
+            return None
+        if self._body_end is not None:
+            if self._end < self._body_end:
+                return None
+            frame_end = self._body_end
+        else:
+            if not self._delimiter:
+                raise ValueError("MJPEG part has neither Content-Length nor boundary")
+            frame_end = self._buf.find(self._delimiter, self._scan_from, self._end)
+            if frame_end == -1:
+                self._scan_from = max(self._body_start,
+                                      self._end - len(self._delimiter) + 1)
+                return None
+            while frame_end > self._body_start and self._buf[frame_end - 1] in b"\r\n":
+                frame_end -= 1
+        frame = bytes(memoryview(self._buf)[self._body_start:frame_end])
+        self._start = frame_end
+        self._body_start = self._body_end = None
+        return frame
+
+
+class MjpegReader():
+    """
+    MJPEG format
+
+    Content-Type: multipart/x-mixed-replace; boundary=--BoundaryString
+    --BoundaryString
+    Content-type: image/jpg
+    Content-Length: 12390
+
+    ... image-data here ...
+
+
+    --BoundaryString
+    Content-type: image/jpg
+    Content-Length: 12390
+
+    ... image-data here ...
+    """
+    def __init__(self, url: str):
+        self._url = url
+        self._stream = None
+
+    def close(self):
+        """ close current connection, make aiter_content stop """
+        if self._stream:
+            self._stream.close()
+
+    async def aiter_content(self):
+        """
+        Ref:
+        - https://stackoverflow.com/questions/32310951/how-to-get-the-underlying-socket-when-using-python-requests
+        - https://www.tornadoweb.org/en/stable/iostream.html
+        - https://realpython.com/async-io-python/#other-features-async-for-and-async-generators-comprehensions
+        """
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+        stream = IOStream(s)
+        self._stream = stream
+        try:
+            url = urllib.request.urlparse(self._url)
+            host, port = url.netloc.split(":")
+            port = int(port)
+            path = url.path or "/"
+            await stream.connect((host, port))
+            await stream.write(
+                "GET {path} HTTP/1.0\r\nHost: {netloc}\r\n\r\n".format(
+                    path=path, netloc=url.netloc).encode('utf-8'))
+            header_data = await stream.read_until(b"\r\n\r\n")
+
+            parser = MjpegParser()
+            while True:
+                n = await stream.read_into(parser.get_buffer(), partial=True)
+                for frame in parser.feed(n):
+                    yield frame
+        finally:
+            stream.close()
+            if self._stream is stream:
+                self._stream = None
+
+
+def put_latest(queue: Queue, item):
+    """ put item to bounded queue, drop the oldest one when full """
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(item)
+
+
+class MjpegBroadcaster():
+    """
+    Share one upstream MJPEG connection with all viewers
+
+    Upstream connects when the first subscriber comes, and closed when the last one leaves.
+    Every subscriber got a bounded queue, when it is full the oldest frame is dropped,
+    so a slow viewer never blocks the others. None in queue means upstream closed.
+    """
+    def __init__(self, reader: MjpegReader, queue_size: int = 2):
+        self._reader = reader
+        self._queue_size = queue_size
+        self._subscribers = set()
+        self._latest_frame = None
+        self._latest_time = 0.0
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    def latest_frame(self, max_age: float = 1.0):
+        """ return the latest frame when stream is active and frame is not older than max_age """
+        if not self._subscribers:
+            return None
+        if tornado.ioloop.IOLoop.current().time() - self._latest_time > max_age:
+            return None
+        return self._latest_frame
+
+    def subscribe(self) -> Queue:
+        queue = Queue(maxsize=self._queue_size)
+        if not self._subscribers:
+            # new set for the new upstream, previous one may still be closing
+            self._subscribers = set()
+            tornado.ioloop.IOLoop.current().spawn_callback(
+                self._run, self._subscribers)
+        self._subscribers.add(queue)
+        return queue
+
+    def close(self):
+        """ disconnect upstream, all subscribers got None """
+        self._reader.close()
+
+    def unsubscribe(self, queue: Queue):
+        self._subscribers.discard(queue)
+        if not self._subscribers:
+            self._reader.close()
+
+    async def _run(self, subscribers: set):
+        try:
+            async for content in self._reader.aiter_content():
+                if not subscribers:
+                    break
+                self._latest_frame = content
+                self._latest_time = tornado.ioloop.IOLoop.current().time()
+                for queue in subscribers:
+                    put_latest(queue, content)
+        except (OSError, StreamClosedError) as e:
+            if subscribers:
+                logger.warning("mjpeg upstream error: %s", e)
+        finally:
+            for queue in subscribers:
+                put_latest(queue, None)
+            subscribers.clear()
@@ -0,0 +1,90 @@
+# coding: utf-8
+#
+# Advertised address of this provider
+
+import re
+import socket
+import subprocess
+
+from logzero import logger
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+INET_RE = re.compile(r"inet (?:addr:)?(\d+\.\d+\.\d+\.\d+)")
+
+
+def route_ip() -> str:
+    """ source address of the default route, no packet is sent """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.connect(("8.8.8.8", 80))
+        return s.getsockname()[0]
+
+
+def interface_ip(name: str) -> str:
+    """
+    Raises:
+        OSError: interface not found or has no ipv4 address
+    """
+    for cmd in (["ifconfig", name], ["ip", "-4", "addr", "show", "dev", name]):
+        try:
+            output = subprocess.check_output(cmd, stderr=subprocess.DEVNULL, timeout=5)
+        except (OSError, subprocess.SubprocessError):
+            continue
+        for ip in INET_RE.findall(output.decode('utf-8', errors='replace')):
+            if not ip.startswith("127."):
+                return ip
+    raise OSError("no ipv4 address of interface: " + name)
+
+
+class NetworkIdentity(object):
+    """
+    Resolve advertised ip once, then poll for changes
+
+    - address: fixed, never changes
+    - interface: ipv4 address of the interface, eg: en0
+    - otherwise: source address of the default route, 127.0.0.1 when offline
+
+    Example usage:
+
+    network = NetworkIdentity(interface="en0")
+    network.add_listener(on_change) # async def on_change(old_ip, new_ip)
+    IOLoop.current().spawn_callback(network.watch)
+    print(network.ip)
+    """
+
+    def __init__(self, address: str = None, interface: str = None, poll_interval: float = 10.0):
+        self._address = address
+        self._interface = interface
+        self._poll_interval = poll_interval
+        self._listeners = []
+        self.ip = self.resolve()
+
+    def resolve(self) -> str:
+        if self._address:
+            return self._address
+        try:
+            if self._interface:
+                return interface_ip(self._interface)
+            return route_ip()
+        except OSError as e:
+            logger.warning("resolve ip error: %s", e)
+            return getattr(self, "ip", None) or "127.0.0.1"
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    async def watch(self):
+        if self._address:
+            return
+        while True:
+            await gen.sleep(self._poll_interval)
+            ip = await IOLoop.current().run_in_executor(None, self.resolve)
+            if ip == self.ip:
+                continue
+            old_ip, self.ip = self.ip, ip
+            logger.info("ip changed: %s -> %s", old_ip, ip)
+            for callback in self._listeners:
+                try:
+                    await callback(old_ip, ip)
+                except Exception as e:
+                    logger.warning("ip change listener error: %s", e)
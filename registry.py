@@ -0,0 +1,145 @@
+# coding: utf-8
+#
+# State of all devices of this provider, queried by GET /devices
+
+import fnmatch
+import time
+import uuid
+from collections import defaultdict
+
+
+class DeviceRegistry(object):
+    """
+    Every device has a WDADevice, and a record (dict) of its state, eg:
+
+    {
+        "udid": "xxxx", "name": "iPhone", "product": "iPhone 12", "launchMode": "xcodebuild",
+        "status": "ready", "ip": "10.0.0.2", "version": "15.0", "sdkVersion": "15.0",
+        "wdaUrl": "http://10.0.0.1:20003", "ports": {"wda": 20001, "mjpeg": 20002, "proxy": 20003},
+        "launchWaitTime": 0.0, "wdaStatus": {...}, "nextProbeAt": 1600000060.0,
+        "processes": [{"name": "launcher", "pid": 123, "running": true, "startTime": 1600000000.0,
+                       "restarts": 0, "exitCodes": []}, ...],
+        "updatedAt": 1600000000.0
+    }
+
+    Records are indexed by INDEXES, so queries like status=ready, product=iPhone 12,
+    version=15.* only visit matching devices. etag changes whenever any record changes.
+
+    Example usage:
+
+    registry.add(d) # d: idb.WDADevice
+    registry.update(d.udid, status="ready", ip="10.0.0.2")
+    registry.query(status="ready", version="15.*")
+    registry.remove(d.udid)
+    """
+
+    INDEXES = ("status", "product", "version", "ip")
+
+    def __init__(self):
+        self._devices = {}  # udid -> WDADevice
+        self._records = {}  # udid -> dict
+        self._indexes = {name: defaultdict(set) for name in self.INDEXES}  # name -> value -> udids
+        self._instance = uuid.uuid4().hex[:8]  # etag never repeats after restart
+        self._generation = 0
+
+    @property
+    def etag(self) -> str:
+        return '"{}-{}"'.format(self._instance, self._generation)
+
+    def __contains__(self, udid: str) -> bool:
+        return udid in self._devices
+
+    def __len__(self) -> int:
+        return len(self._devices)
+
+    def device(self, udid: str):
+        """ return WDADevice or None """
+        return self._devices.get(udid)
+
+    def devices(self) -> list:
+        return list(self._devices.values())
+
+    def add(self, device):
+        self._devices[device.udid] = device
+        self._records[device.udid] = {"udid": device.udid}
+        self.update(device.udid,
+                    name=device.name,
+                    product=device.product,
+                    launchMode=device.launch_mode,
+                    status=device.status)
+
+    def remove(self, udid: str):
+        """ return removed WDADevice or None """
+        record = self._records.pop(udid, None)
+        if record:
+            for name in self.INDEXES:
+                self._unindex(name, record.get(name), udid)
+            self._generation += 1
+        return self._devices.pop(udid, None)
+
+    def update(self, udid: str, **fields):
+        """ set fields of device record, ignored when device is removed """
+        record = self._records.get(udid)
+        if record is None:
+            return
+        changed = {k: v for k, v in fields.items() if record.get(k) != v}
+        if not changed:
+            return
+        for name in self.INDEXES:
+            if name in changed:
+                self._unindex(name, record.get(name), udid)
+                if changed[name] is not None:
+                    self._indexes[name][changed[name]].add(udid)
+        record.update(changed)
+        record['updatedAt'] = time.time()
+        self._generation += 1
+
+    def _unindex(self, name: str, value, udid: str):
+        udids = self._indexes[name].get(value)
+        if udids is not None:
+            udids.discard(udid)
+            if not udids:
+                del self._indexes[name][value]
+
+    def get(self, udid: str) -> dict:
+        record = self._records.get(udid)
+        return dict(record) if record else None
+
+    def counts(self, name: str) -> dict:
+        """ number of devices of every value of index name """
+        return {value: len(udids) for value, udids in self._indexes[name].items()}
+
+    def query(self, **filters) -> list:
+        """
+        Args:
+            filters: field name -> fnmatch pattern, or list of patterns (any of them)
+
+        Returns:
+            list of records, sorted by udid
+        """
+        udids = None
+        others = {}
+        for name, patterns in filters.items():
+            if isinstance(patterns, str):
+                patterns = [patterns]
+            if name not in self._indexes:
+                others[name] = patterns
+                continue
+            matched = set()
+            for value, value_udids in self._indexes[name].items():
+                if any(fnmatch.fnmatchcase(str(value), p) for p in patterns):
+                    matched.update(value_udids)
+            udids = matched if udids is None else udids & matched
+        if udids is None:
+            udids = self._records.keys()
+
+        records = []
+        for udid in sorted(udids):
+            record = self._records[udid]
+            if all(any(fnmatch.fnmatchcase(str(record.get(name, "")), p) for p in patterns)
+                   for name, patterns in others.items()):
+                records.append(dict(record))
+        return records
+
+
+registry = DeviceRegistry()
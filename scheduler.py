@@ -0,0 +1,284 @@
+# coding: utf-8
+#
+# Decide when devices launch WebDriverAgent and when to check its health
+
+import heapq
+import itertools
+import random
+import time
+from collections import defaultdict
+
+from logzero import logger
+from tornado import locks
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.util import TimeoutError
+
+import metrics
+from registry import registry
+
+# default max concurrent launches of every launch mode, 0 means unlimited
+# xcodebuild test can not install test runner in parallel
+DEFAULT_LAUNCH_LIMITS = {
+    "xcodebuild": 1,
+    "simulator": 2,
+    "tidevice": 4,
+    "manual": 0,
+}
+
+
+def parse_launch_limits(items: list) -> dict:
+    """
+    Args:
+        items: eg: ["tidevice=8", "simulator=4"]
+
+    Raises:
+        ValueError
+    """
+    limits = {}
+    for item in items or []:
+        mode, _, limit = item.partition("=")
+        if mode not in DEFAULT_LAUNCH_LIMITS:
+            raise ValueError("unknown launch mode: " + mode, list(DEFAULT_LAUNCH_LIMITS))
+        limits[mode] = int(limit)
+    return limits
+
+
+class LaunchSlot(object):
+    """ returned by LaunchScheduler.slot, release() can be called before leaving the context """
+
+    def __init__(self, scheduler, mode: str, udid: str, priority: tuple):
+        self._scheduler = scheduler
+        self._mode = mode
+        self._udid = udid
+        self._priority = priority
+        self._acquired = False
+        self.wait_time = 0.0
+
+    async def __aenter__(self):
+        self.wait_time = await self._scheduler.acquire(self._mode, self._udid,
+                                                       self._priority)
+        self._acquired = True
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def release(self):
+        if self._acquired:
+            self._acquired = False
+            self._scheduler.release(self._mode)
+
+
+class LaunchScheduler(object):
+    """
+    Every launch mode has its own concurrency limit, waiting devices are served
+    by priority: devices which have been ready before go first, then the recently
+    requested ones.
+
+    Example usage:
+
+    scheduler = LaunchScheduler()
+    async with scheduler.slot("xcodebuild", udid) as slot:
+        ... # install test runner
+        slot.release() # let next device go
+    """
+
+    def __init__(self, limits: dict = None):
+        self._limits = dict(DEFAULT_LAUNCH_LIMITS)
+        self._limits.update(limits or {})
+        self._running = defaultdict(int)  # mode -> count
+        self._waiting = defaultdict(list)  # mode -> heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self._healthy = set()  # udids which have been ready
+        self._requested = {}  # udid -> last requested timestamp
+
+    def mark_healthy(self, udid: str):
+        self._healthy.add(udid)
+
+    def mark_requested(self, udid: str):
+        """ called when device is used by someone, eg: cold, app install """
+        self._requested[udid] = time.time()
+
+    def priority(self, udid: str) -> tuple:
+        """ smaller goes first """
+        return (0 if udid in self._healthy else 1, -self._requested.get(udid, 0))
+
+    def queue_sizes(self) -> dict:
+        """ waiting devices of every launch mode, reported by metrics """
+        return {(mode, ): len(self._waiting[mode]) for mode in self._limits}
+
+    def slot(self, mode: str, udid: str) -> LaunchSlot:
+        return LaunchSlot(self, mode, udid, self.priority(udid))
+
+    async def acquire(self, mode: str, udid: str, priority: tuple = ()) -> float:
+        """
+        Returns:
+            seconds waited in queue
+        """
+        start = time.time()
+        limit = self._limits.get(mode, 1)
+        if limit > 0 and (self._running[mode] >= limit or self._waiting[mode]):
+            future = Future()
+            heapq.heappush(self._waiting[mode], (priority, next(self._seq), future))
+            logger.debug("%s wait for %s launch, queue size: %d", udid[:7], mode,
+                         len(self._waiting[mode]))
+            await future  # running count is increased by release()
+        else:
+            self._running[mode] += 1
+        wait_time = time.time() - start
+        logger.debug("%s %s launch start, waited %.1fs", udid[:7], mode, wait_time)
+        return wait_time
+
+    def release(self, mode: str):
+        self._running[mode] -= 1
+        waiting = self._waiting[mode]
+        while waiting:
+            _, _, future = heapq.heappop(waiting)
+            if not future.done():
+                self._running[mode] += 1
+                future.set_result(None)
+                break
+
+
+class _HealthEntry(object):
+    def __init__(self, device):
+        self.device = device
+        self.next_time = 0.0  # IOLoop time
+        self.interval = 0.0
+        self.failures = 0
+        self.successes = 0
+
+
+class HealthCheckScheduler(object):
+    """
+    Run health probes of all devices from one timer heap
+
+    - interval is jittered, so devices launched together do not probe in lockstep
+    - devices that keep passing back off up to max_interval
+    - after a failure, or while the device is being proxied, probe every min_interval / active_interval
+    - at most max_inflight probes run at the same time
+
+    Device should provide:
+    - udid: str
+    - is_active: bool, call mark_active() when it becomes True
+    - async health_probe() -> bool
+    - health_failed(): called when probe failed more than max_failures times in a row,
+      the device is removed from scheduler
+    """
+
+    def __init__(self,
+                 interval: float = 60.0,
+                 min_interval: float = 10.0,
+                 max_interval: float = 300.0,
+                 active_interval: float = 15.0,
+                 jitter: float = 0.2,
+                 max_inflight: int = 4,
+                 max_failures: int = 3):
+        self._heap = []  # (next_time, seq, udid)
+        self._entries = {}  # udid -> _HealthEntry
+        self._seq = itertools.count()
+        self._wakeup = locks.Event()
+        self._running = False
+        self.configure(interval=interval,
+                       min_interval=min_interval,
+                       max_interval=max_interval,
+                       active_interval=active_interval,
+                       jitter=jitter,
+                       max_inflight=max_inflight,
+                       max_failures=max_failures)
+
+    def configure(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+        self._semaphore = locks.Semaphore(self.max_inflight)
+
+    def add(self, device):
+        entry = _HealthEntry(device)
+        self._entries[device.udid] = entry
+        # first probe is spread over one interval
+        self._schedule(entry, random.uniform(self.min_interval, self.interval))
+        if not self._running:
+            self._running = True
+            IOLoop.current().spawn_callback(self._run)
+
+    def remove(self, udid: str):
+        if self._entries.pop(udid, None):
+            registry.update(udid, nextProbeAt=None)
+
+    def mark_active(self, udid: str):
+        """ device is being proxied, probe it within active_interval instead of its backoff """
+        entry = self._entries.get(udid)
+        interval = min(self.active_interval, self.interval)
+        if entry and entry.next_time - IOLoop.current().time() > interval:
+            self._schedule(entry, interval)
+
+    def next_probe_time(self, udid: str):
+        """ return unix timestamp of next probe, or None if device is not scheduled """
+        entry = self._entries.get(udid)
+        if not entry:
+            return None
+        return time.time() + entry.next_time - IOLoop.current().time()
+
+    def _schedule(self, entry: _HealthEntry, interval: float):
+        jitter = random.uniform(1 - self.jitter, 1 + self.jitter)
+        entry.interval = interval
+        entry.next_time = IOLoop.current().time() + interval * jitter
+        heapq.heappush(self._heap,
+                       (entry.next_time, next(self._seq), entry.device.udid))
+        self._wakeup.set()
+        registry.update(entry.device.udid,
+                        nextProbeAt=round(self.next_probe_time(entry.device.udid), 3))
+
+    def _next_interval(self, entry: _HealthEntry) -> float:
+        if entry.failures:
+            return self.min_interval
+        if entry.device.is_active:
+            return min(self.active_interval, self.interval)
+        # double the interval after every 5 passes
+        return min(self.max_interval, self.interval * 2**(entry.successes // 5))
+
+    async def _run(self):
+        while True:
+            now = IOLoop.current().time()
+            while self._heap and self._heap[0][0] <= now:
+                next_time, _, udid = heapq.heappop(self._heap)
+                entry = self._entries.get(udid)
+                if entry and entry.next_time == next_time:  # skip stale items
+                    IOLoop.current().spawn_callback(self._probe, entry)
+            self._wakeup.clear()
+            deadline = self._heap[0][0] if self._heap else None
+            try:
+                await self._wakeup.wait(deadline)
+            except TimeoutError:
+                pass
+
+    async def _probe(self, entry: _HealthEntry):
+        device = entry.device
+        async with self._semaphore:
+            if self._entries.get(device.udid) is not entry:
+                return
+            start = time.time()
+            ok = await device.health_probe()
+            metrics.wda_health_probe_seconds.observe(time.time() - start,
+                                                     result="ok" if ok else "fail")
+        if self._entries.get(device.udid) is not entry:
+            return
+
+        if ok:
+            if entry.failures:
+                logger.info("%s wda ping recovered", device)
+            entry.failures = 0
+            entry.successes += 1
+        else:
+            entry.failures += 1
+            entry.successes = 0
+            logger.warning("%s wda ping error: %d", device, entry.failures)
+            if entry.failures > self.max_failures:
+                self.remove(device.udid)
+                device.health_failed()
+                return
+        self._schedule(entry, self._next_interval(entry))
+
+
+health_scheduler = HealthCheckScheduler()
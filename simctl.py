@@ -0,0 +1,104 @@
+# coding: utf-8
+#
+# iOS simulators from `xcrun simctl list devices -j`
+
+import json
+import re
+import subprocess
+import threading
+import time
+from collections import namedtuple
+
+from logzero import logger
+
+Simulator = namedtuple("Simulator", ["udid", "name", "runtime", "state"])
+
+# eg: com.apple.CoreSimulator.SimRuntime.iOS-15-0, or "iOS 12.1" of old Xcode
+_RUNTIME_RE = re.compile(r"(?:SimRuntime\.)?([A-Za-z]+)[- ]([\d.-]+)$")
+
+
+def parse_runtime(key: str) -> str:
+    """ com.apple.CoreSimulator.SimRuntime.iOS-15-0 -> iOS 15.0 """
+    m = _RUNTIME_RE.search(key)
+    if not m:
+        return key
+    return m.group(1) + " " + m.group(2).replace("-", ".")
+
+
+def parse_devices(data: dict) -> list:
+    """
+    Args:
+        data: output of simctl list devices -j
+
+    Returns:
+        list of Simulator, unavailable ones are skipped
+    """
+    sims = []
+    for runtime, devices in data.get("devices", {}).items():
+        for d in devices:
+            if d.get("isAvailable") is False or "unavailable" in d.get("availability", ""):
+                continue
+            sims.append(Simulator(d['udid'], d['name'], parse_runtime(runtime), d['state']))
+    return sims
+
+
+class Simctl(object):
+    """
+    simctl is run at most once every max_age seconds, invalidate() makes the next call run it again.
+    Concurrent callers share one run.
+
+    Example usage:
+
+    simctl = Simctl()
+    for sim in simctl.booted():
+        print(sim.udid, sim.name, sim.runtime)
+    """
+
+    def __init__(self, xcrun: str = "xcrun", max_age: float = 10.0):
+        """
+        Args:
+            xcrun: path of xcrun, eg: a stub which prints canned json
+        """
+        self.xcrun = xcrun
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._devices = []
+        self._updated = None  # monotonic time of last run, None: never run or invalidated
+
+    def invalidate(self):
+        self._updated = None
+
+    def _run(self) -> list:
+        try:
+            output = subprocess.check_output(
+                [self.xcrun, "simctl", "list", "devices", "-j"],
+                stderr=subprocess.DEVNULL, timeout=30)
+            return parse_devices(json.loads(output))
+        except (OSError, subprocess.SubprocessError):  # no xcode, eg: linux
+            return []
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning("parse simctl output error: %s", e)
+            return []
+
+    def devices(self, refresh: bool = False) -> list:
+        """ all available simulators """
+        with self._lock:
+            updated = self._updated
+            if refresh or updated is None or time.monotonic() - updated > self.max_age:
+                self._devices = self._run()
+                self._updated = time.monotonic()
+            return self._devices
+
+    def booted(self) -> list:
+        return [sim for sim in self.devices() if sim.state == "Booted"]
+
+    def get(self, udid: str):
+        """ return Simulator or None, run simctl again once when udid is not known """
+        for refresh in (False, True):
+            for sim in self.devices(refresh):
+                if sim.udid == udid:
+                    return sim
+        return None
+
+
+simctl = Simctl()
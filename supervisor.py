@@ -0,0 +1,221 @@
+# coding: utf-8
+#
+# Run child processes of a device as asyncio subprocesses, notice their exit at once
+
+import asyncio
+import subprocess
+import time
+from collections import OrderedDict, deque
+
+from logzero import logger
+from tornado import locks
+from tornado.ioloop import IOLoop
+
+import metrics
+
+
+class ManagedProcess(object):
+    """ one named child process, spawned again with the same name on restart """
+
+    def __init__(self, name: str, args: list, **kwargs):
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+        self.restart = False  # spawn again when exited unexpectedly
+        self.on_output = None
+        self.proc = None
+        self.start_time = None
+        self.restarts = 0
+        self.exit_codes = deque(maxlen=10)
+        self._stopping = False
+
+    @property
+    def pid(self):
+        return self.proc.pid if self.proc else None
+
+    @property
+    def running(self) -> bool:
+        return self.proc is not None and self.proc.returncode is None
+
+    async def spawn(self):
+        kwargs = dict(self.kwargs)
+        kwargs.setdefault("stdin", subprocess.DEVNULL)
+        if self.on_output:
+            kwargs['stdout'] = asyncio.subprocess.PIPE
+            kwargs['stderr'] = asyncio.subprocess.STDOUT
+        logger.debug("exec: %s", subprocess.list2cmdline(self.args))
+        self._stopping = False
+        self.proc = await asyncio.create_subprocess_exec(*self.args, **kwargs)
+        self.start_time = time.time()
+        if self.on_output:
+            IOLoop.current().spawn_callback(self._read_output, self.proc.stdout,
+                                            self.on_output)
+
+    async def _read_output(self, stream: asyncio.StreamReader, on_output):
+        while True:
+            try:
+                line = await stream.readline()
+            except ValueError:  # line too long
+                continue
+            if not line:
+                break
+            on_output(line.decode('utf-8', errors='replace').rstrip())
+
+    async def stop(self, timeout: float = 5.0):
+        """ terminate, kill if still alive after timeout, then reap """
+        self._stopping = True
+        proc = self.proc
+        if proc is None or proc.returncode is not None:
+            return
+        try:
+            proc.terminate()
+            await asyncio.wait_for(proc.wait(), timeout)
+        except ProcessLookupError:
+            pass
+        except asyncio.TimeoutError:
+            logger.warning("%s(pid=%d) not quit in %.0fs, kill it", self.name,
+                           proc.pid, timeout)
+            proc.kill()
+            await proc.wait()
+
+    def info(self) -> dict:
+        return {
+            "name": self.name,
+            "pid": self.pid,
+            "running": self.running,
+            "startTime": self.start_time,
+            "restarts": self.restarts,
+            "exitCodes": list(self.exit_codes),
+        }
+
+
+class ProcessSupervisor(object):
+    """
+    Children with restart=True are spawned again right after they exit,
+    any other child exiting unexpectedly sets the exited event.
+
+    Example usage:
+
+    supervisor = ProcessSupervisor("device-name")
+    await supervisor.start("relay", ["tidevice", "relay", "8100", "8100"], restart=True)
+    await supervisor.start("xcodebuild", ["xcodebuild", "test"], on_output=print)
+    await supervisor.exited.wait()
+    await supervisor.stop_all()
+    """
+
+    def __init__(self,
+                 name: str = "",
+                 restart_delay: float = 1.0,
+                 max_restart_delay: float = 30.0,
+                 stop_timeout: float = 5.0):
+        self._name = name
+        self._restart_delay = restart_delay
+        self._max_restart_delay = max_restart_delay
+        self._stop_timeout = stop_timeout
+        self._procs = OrderedDict()  # name -> ManagedProcess
+        self.exited = locks.Event()
+        self.last_exit = None  # (name, exit code)
+        self.on_change = None  # function () -> None, called when a child spawned or exited
+
+    def __iter__(self):
+        return iter(self._procs.values())
+
+    def get(self, name: str) -> ManagedProcess:
+        return self._procs.get(name)
+
+    async def start(self,
+                    name: str,
+                    args: list,
+                    restart: bool = False,
+                    on_output=None,
+                    silent: bool = False,
+                    **kwargs) -> ManagedProcess:
+        """
+        Start a child, the running one with the same name is stopped first
+
+        Args:
+            restart: spawn again after exited
+            on_output: function (str) -> None, called with every line of stdout and stderr
+            silent: drop stdout and stderr
+            kwargs: passed to asyncio.create_subprocess_exec
+        """
+        if silent:
+            kwargs['stdout'] = subprocess.DEVNULL
+            kwargs['stderr'] = subprocess.DEVNULL
+        mp = self._procs.get(name)
+        if mp:
+            await mp.stop(self._stop_timeout)
+            mp.args, mp.kwargs = args, kwargs
+            mp.restarts += 1
+        else:
+            mp = self._procs[name] = ManagedProcess(name, args, **kwargs)
+        mp.restart = restart
+        mp.on_output = on_output
+        await mp.spawn()
+        self._changed()
+        IOLoop.current().spawn_callback(self._watch, mp, mp.proc)
+        return mp
+
+    def _changed(self):
+        if self.on_change:
+            self.on_change()
+
+    async def _watch(self, mp: ManagedProcess, proc):
+        delay = self._restart_delay
+        while True:
+            code = await proc.wait()
+            mp.exit_codes.append(code)
+            self._changed()
+            if mp._stopping or mp.proc is not proc:
+                return
+            logger.warning("%s %s(pid=%d) exited with code %d", self._name,
+                           mp.name, proc.pid, code)
+            if not mp.restart:
+                self.last_exit = (mp.name, code)
+                self.exited.set()
+                return
+
+            # back off when crashed again right after restarted
+            if time.time() - mp.start_time >= self._max_restart_delay:
+                delay = self._restart_delay
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self._max_restart_delay)
+            if mp._stopping or mp.proc is not proc:
+                return
+            mp.restarts += 1
+            metrics.process_restarts_total.inc(name=mp.name)
+            try:
+                await mp.spawn()
+            except OSError as e:
+                logger.warning("%s %s restart error: %s", self._name, mp.name, e)
+                self.last_exit = (mp.name, None)
+                self.exited.set()
+                return
+            self._changed()
+            proc = mp.proc
+
+    def swap(self, name: str, other: str):
+        """ exchange names of two children, eg: promote a standby one """
+        mp, other_mp = self._procs[name], self._procs[other]
+        mp.name, other_mp.name = other, name
+        self._procs[name], self._procs[other] = other_mp, mp
+        self._changed()
+
+    async def stop(self, name: str):
+        mp = self._procs.get(name)
+        if mp:
+            await mp.stop(self._stop_timeout)
+
+    async def stop_all(self):
+        await asyncio.gather(
+            *[mp.stop(self._stop_timeout) for mp in self._procs.values()])
+
+    def terminate_all(self):
+        """ send SIGTERM without waiting, used when the event loop is gone """
+        for mp in self._procs.values():
+            mp._stopping = True
+            if mp.running:
+                mp.proc.terminate()
+
+    def stats(self) -> list:
+        return [mp.info() for mp in self._procs.values()]
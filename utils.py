@@ -1,7 +1,7 @@
 # coding: utf-8
 #
 
-import collections
+import collections.abc
 import random
 import re
 import socket
@@ -18,7 +18,7 @@ def current_ip():
 
 def update_recursive(d: dict, u: dict) -> dict:
     for k, v in u.items():
-        if isinstance(v, collections.Mapping):
+        if isinstance(v, collections.abc.Mapping):
             d[k] = update_recursive(d.get(k) or {}, v)
         else:
             d[k] = v
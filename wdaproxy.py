@@ -0,0 +1,939 @@
+# coding: utf-8
+#
+# WDA reverse proxy and /screen websocket
+#
+# Used by wdaproxy-script.py (one process per device), and by WDAProxyGateway
+# which serves all devices inside the provider process.
+
+import base64
+import json
+import re
+import time
+from collections import OrderedDict
+
+import httpx
+import tornado.ioloop
+import tornado.web
+from logzero import logger
+from tornado import gen, locks
+from tornado.httpserver import HTTPServer
+from tornado.queues import Queue
+from tornado.websocket import WebSocketHandler, WebSocketClosedError
+
+from mjpeg import MjpegBroadcaster, MjpegReader, put_latest
+
+
+# Ref: https://www.rfc-editor.org/rfc/rfc7230#section-6.1
+HOP_BY_HOP_HEADERS = frozenset([
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailer", "transfer-encoding", "upgrade"
+])
+
+
+# device with client requests in last seconds is active, its health is probed more often
+ACTIVE_SECONDS = 60
+
+SCREENSHOT_PATH_RE = re.compile(r"^(/session/[^/]+)?/screenshot/?$")
+SESSION_PATH_RE = re.compile(r"^/session/?$")
+SESSION_ID_PATH_RE = re.compile(r"^/session/([^/]+)/?$")
+
+# idempotent WDA GET endpoints which can be cached, name -> path pattern
+CACHEABLE_ENDPOINTS = {
+    "source": re.compile(r"^(/session/[^/]+)?/source/?$"),
+    "window_size": re.compile(r"^(/session/[^/]+)?/window/size/?$"),
+    "wda_screen": re.compile(r"^(/session/[^/]+)?/wda/screen/?$"),
+    "status": re.compile(r"^/status/?$"),
+    "orientation": re.compile(r"^/session/[^/]+/orientation/?$"),
+}
+
+# default seconds to keep cached response of CACHEABLE_ENDPOINTS
+DEFAULT_CACHE_TTLS = {
+    "source": 1.0,
+    "window_size": 30.0,
+    "wda_screen": 30.0,
+    "status": 2.0,
+    "orientation": 5.0,
+}
+
+
+def parse_cache_ttls(items: list) -> dict:
+    """
+    Args:
+        items: eg: ["source=2", "status=0.5"]
+
+    Raises:
+        ValueError
+    """
+    ttls = {}
+    for item in items or []:
+        name, _, seconds = item.partition("=")
+        if name not in CACHEABLE_ENDPOINTS:
+            raise ValueError("unknown cache endpoint: " + name, list(CACHEABLE_ENDPOINTS))
+        ttls[name] = float(seconds)
+    return ttls
+
+
+# /screen control message key -> (WDA appium setting, min, max)
+SCREEN_OPTIONS = {
+    "fps": ("mjpegServerFramerate", 1, 60),
+    "scale": ("mjpegScalingFactor", 1, 100),
+    "quality": ("mjpegServerScreenshotQuality", 1, 100),
+}
+
+
+def parse_screen_options(message) -> dict:
+    """
+    Args:
+        message: /screen control message, eg: {"fps": 5, "scale": 50}, null resets an option
+
+    Raises:
+        ValueError, TypeError
+    """
+    data = json.loads(message)
+    if not isinstance(data, dict):
+        raise ValueError("control message should be an object")
+    options = {}
+    for key, value in data.items():
+        if key not in SCREEN_OPTIONS:
+            raise ValueError("unknown option {}, should be one of: {}".format(
+                key, ", ".join(SCREEN_OPTIONS)))
+        if value is not None:
+            _, low, high = SCREEN_OPTIONS[key]
+            value = int(value)
+            if not low <= value <= high:
+                raise ValueError("{} should be between {} and {}".format(key, low, high))
+        options[key] = value
+    return options
+
+
+def is_default_session_request(body: bytes) -> bool:
+    """ POST /session body without any capability, eg: {"capabilities": {"alwaysMatch": {}}} """
+    if not body.strip():
+        return True
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return False
+
+    def empty(value) -> bool:
+        if isinstance(value, dict):
+            return all(empty(v) for v in value.values())
+        if isinstance(value, list):
+            return all(empty(v) for v in value)
+        return value is None
+
+    return isinstance(data, dict) and empty(data)
+
+
+class UpstreamResponse(object):
+    """ buffered WDA response """
+
+    def __init__(self, status: int, reason: str, headers: list, body: bytes):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+
+class SingleFlightCache(object):
+    """
+    Concurrent calls with the same key share one fetch,
+    successful result is kept for ttl seconds.
+    When max_bytes > 0, least recently used results are dropped to keep body size under it.
+    """
+
+    def __init__(self, ttl: float, max_bytes: int = 0):
+        self._ttl = ttl
+        self._max_bytes = max_bytes
+        self._inflight = {}  # key -> Future
+        self._results = OrderedDict()  # key -> (expire_time, UpstreamResponse)
+        self._bytes = 0
+        self._generation = 0  # increased by clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._results),
+            "bytes": self._bytes,
+        }
+
+    async def get(self, key, fetch, ttl: float = None) -> UpstreamResponse:
+        """
+        Args:
+            fetch: coroutine function return UpstreamResponse
+            ttl: override default ttl
+        """
+        cached = self._results.get(key)
+        if cached:
+            if cached[0] > tornado.ioloop.IOLoop.current().time():
+                self._results.move_to_end(key)
+                self.hits += 1
+                return cached[1]
+            self._pop(key)
+        future = self._inflight.get(key)
+        if future is None:
+            self.misses += 1
+            ttl = self._ttl if ttl is None else ttl
+            future = gen.convert_yielded(self._fetch(key, fetch, ttl))
+            self._inflight[key] = future
+        else:
+            self.hits += 1
+        return await future
+
+    async def _fetch(self, key, fetch, ttl: float) -> UpstreamResponse:
+        generation = self._generation
+        try:
+            resp = await fetch()
+            # result may be stale when clear() called during fetch
+            if resp.status == 200 and ttl > 0 and generation == self._generation:
+                self._store(key, resp, ttl)
+            return resp
+        finally:
+            if generation == self._generation:
+                self._inflight.pop(key, None)
+
+    def _store(self, key, resp: UpstreamResponse, ttl: float):
+        if self._max_bytes and len(resp.body) > self._max_bytes:
+            return
+        self._pop(key)
+        expire = tornado.ioloop.IOLoop.current().time() + ttl
+        self._results[key] = (expire, resp)
+        self._bytes += len(resp.body)
+        while self._max_bytes and self._bytes > self._max_bytes:
+            self._pop(next(iter(self._results)))
+
+    def _pop(self, key):
+        cached = self._results.pop(key, None)
+        if cached:
+            self._bytes -= len(cached[1].body)
+
+    def clear(self):
+        self._generation += 1
+        self._inflight = {}
+        self._results.clear()
+        self._bytes = 0
+
+
+class SessionPool(object):
+    """
+    One pre-created WDA session, POST /session without capabilities takes it
+    instead of waiting seconds for WDA to create one.
+
+    WDA keeps only the latest session alive, so there is never more than one,
+    and nothing is created while a session is in use: after one is handed out
+    or created by a client, refill waits until DELETE /session/<id> or
+    release() (eg: device is colded).
+    The session is checked by GET /session/<id> before handed out.
+    """
+
+    def __init__(self, route):
+        """
+        Args:
+            route: DeviceRoute, session is created on its wda_url
+        """
+        self._route = route
+        self.in_use = False
+        self._session = None  # (session_id, UpstreamResponse)
+        self._filling = None  # Future of _fill()
+        self._generation = 0  # increased by clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        return {
+            "idle": self._session is not None,
+            "inUse": self.in_use,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def fill(self):
+        """ create the session in background """
+        if self._filling or self.in_use or self._session:
+            return
+        self._filling = gen.convert_yielded(self._fill(self._generation))
+
+    async def _fill(self, generation: int):
+        try:
+            session = await self._create()
+            if generation == self._generation and not self.in_use:
+                self._session = session
+        except (httpx.HTTPError, ValueError, KeyError, TypeError) as e:
+            if generation == self._generation:  # or cleared meanwhile, eg: wda restarted
+                logger.warning("%s create wda session error: %s", self._route.udid, e)
+        finally:
+            if generation == self._generation:
+                self._filling = None
+
+    async def _create(self) -> tuple:
+        """ return (session_id, UpstreamResponse) """
+        url = self._route.wda_url.rstrip("/") + "/session"
+        resp = await self._route.http_client.post(url, json={"capabilities": {}})
+        resp.raise_for_status()
+        data = resp.json()
+        session_id = data.get("sessionId") or data['value']['sessionId']
+        headers = [("Content-Type", resp.headers.get("Content-Type", "application/json"))]
+        return session_id, UpstreamResponse(resp.status_code, resp.reason_phrase,
+                                            headers, resp.content)
+
+    async def _alive(self, session_id: str) -> bool:
+        url = "{}/session/{}".format(self._route.wda_url.rstrip("/"), session_id)
+        try:
+            resp = await self._route.http_client.get(url)
+            return resp.status_code == 200
+        except httpx.HTTPError:
+            return False
+
+    async def take(self) -> UpstreamResponse:
+        """ return POST /session response of an alive session, or None """
+        if not self._session and self._filling:
+            await self._filling
+        session, self._session = self._session, None
+        if session and await self._alive(session[0]):
+            self.in_use = True
+            self.hits += 1
+            return session[1]
+        if session:
+            logger.debug("%s pooled session %s is gone", self._route.udid, session[0])
+        self.misses += 1
+        return None
+
+    async def hold(self):
+        """ called before a client creates its own session, which kills the pooled one """
+        if self._filling:
+            await self._filling  # or it may kill the client session
+        self.clear()
+        self.in_use = True
+
+    def release(self):
+        """ session in use is deleted, or abandoned when device is colded """
+        self.in_use = False
+        self.fill()
+
+    def clear(self):
+        """ drop the session, eg: wda failed health check """
+        self._generation += 1
+        self._filling = None
+        self._session = None
+        self.in_use = False
+
+
+class MjpegSettings(object):
+    """
+    Screen options wanted by /screen viewers, applied to WDA /appium/settings
+
+    Upstream gets the most demanding value of every option, a viewer without an
+    option wants the WDA default. So a single viewer gets exactly what it asked for,
+    with several ones, viewers wanting a lower fps drop frames by themselves.
+    WDA settings read before the first change are restored when no viewer wants anything.
+    """
+
+    def __init__(self, route):
+        """
+        Args:
+            route: DeviceRoute, settings are posted to its wda_url
+        """
+        self._route = route
+        self._viewers = {}  # viewer -> options
+        self._defaults = None  # WDA settings before the first change
+        self._applied = {}  # options set to WDA
+        self._lock = locks.Lock()
+
+    def set(self, viewer, options: dict):
+        wanted = self._viewers.setdefault(viewer, {})
+        wanted.update(options)
+        for key in [k for k, v in wanted.items() if v is None]:
+            del wanted[key]
+        tornado.ioloop.IOLoop.current().spawn_callback(self._apply)
+
+    def remove(self, viewer):
+        if self._viewers.pop(viewer, None):
+            tornado.ioloop.IOLoop.current().spawn_callback(self._apply)
+
+    def reset(self):
+        """ WDA restarted with its default settings """
+        self._defaults = None
+        self._applied = {}
+        tornado.ioloop.IOLoop.current().spawn_callback(self._apply)
+
+    def drop_fps(self, viewer):
+        """ return fps the viewer should drop frames to, or None """
+        fps = self._viewers.get(viewer, {}).get("fps")
+        if fps and self._applied.get("fps") != fps:
+            return fps
+        return None
+
+    def _target(self) -> dict:
+        if not any(self._viewers.values()):
+            return dict(self._defaults) if self._applied else {}
+        target = {}
+        for key in SCREEN_OPTIONS:
+            values = [options.get(key, self._defaults.get(key))
+                      for options in self._viewers.values()]
+            if None not in values:
+                target[key] = max(values)
+        return target
+
+    async def _apply(self):
+        async with self._lock:
+            try:
+                if self._defaults is None:
+                    if not any(self._viewers.values()):
+                        return
+                    self._defaults = await self._fetch_defaults()
+                target = self._target()
+                changed = {k: v for k, v in target.items() if self._applied.get(k) != v}
+                if not changed:
+                    return
+                await self._post({SCREEN_OPTIONS[k][0]: v for k, v in changed.items()})
+                self._applied.update(changed)
+                logger.debug("%s mjpeg settings: %s", self._route.udid, self._applied)
+            except (httpx.HTTPError, ValueError, KeyError, TypeError) as e:
+                # viewers still drop frames to their fps
+                logger.warning("%s update mjpeg settings error: %s", self._route.udid, e)
+
+    async def _settings_url(self) -> str:
+        """ settings are global in WDA, but old versions require a session id """
+        wda_url = self._route.wda_url.rstrip("/")
+        resp = await self._route.http_client.get(wda_url + "/status")
+        session_id = resp.json().get("sessionId")
+        if session_id:
+            return "{}/session/{}/appium/settings".format(wda_url, session_id)
+        return wda_url + "/appium/settings"
+
+    async def _fetch_defaults(self) -> dict:
+        resp = await self._route.http_client.get(await self._settings_url())
+        resp.raise_for_status()
+        settings = resp.json()['value']
+        return {key: settings[name] for key, (name, _, _) in SCREEN_OPTIONS.items()
+                if name in settings}
+
+    async def _post(self, settings: dict):
+        resp = await self._route.http_client.post(await self._settings_url(),
+                                                  json={"settings": settings})
+        resp.raise_for_status()
+
+
+class DeviceRoute(object):
+    """
+    upstream addresses of one device
+
+    WDA requests go through a connection pool of this device, idle connections
+    are kept for pool_idle_timeout seconds.
+
+    Concurrent GET /screenshot are coalesced into one WDA request, the result is
+    reused for screenshot_ttl seconds. With screenshot_from_mjpeg, /screenshot is
+    answered by the latest MJPEG frame (JPEG, not PNG) when /screen is being watched.
+
+    With response_cache, GET of CACHEABLE_ENDPOINTS are cached (LRU, at most
+    response_cache_max_bytes of body) for response_cache_ttls seconds.
+    Any POST or DELETE to the device drops all cached responses, both when it
+    starts and when WDA has answered it.
+
+    With session_pool, session_pool keeps a pre-created WDA session,
+    it is filled by the owner when WDA is ready.
+
+    mjpeg_settings applies fps, scale and quality wanted by /screen viewers.
+    """
+
+    def __init__(self,
+                 udid: str,
+                 wda_url: str,
+                 mjpeg_url: str,
+                 pool_size: int = 8,
+                 pool_idle_timeout: float = 30.0,
+                 screenshot_ttl: float = 0.3,
+                 screenshot_from_mjpeg: bool = False,
+                 response_cache: bool = False,
+                 response_cache_max_bytes: int = 32 << 20,
+                 response_cache_ttls: dict = None,
+                 session_pool: bool = False):
+        self.udid = udid
+        self.wda_url = wda_url
+        self.mjpeg_url = mjpeg_url
+        self.last_request_time = 0.0  # used to probe busy devices more often
+        self.on_active = None  # called when the first request after ACTIVE_SECONDS of idle comes
+        self.broadcaster = MjpegBroadcaster(MjpegReader(mjpeg_url))
+        self.mjpeg_settings = MjpegSettings(self)
+        self._pool_size = pool_size
+        self._pool_idle_timeout = pool_idle_timeout
+        self.http_client = self._new_http_client()
+        self.screenshot_cache = SingleFlightCache(screenshot_ttl)
+        self.screenshot_from_mjpeg = screenshot_from_mjpeg
+        self.response_cache = None
+        self.response_cache_ttls = dict(DEFAULT_CACHE_TTLS)
+        self.response_cache_ttls.update(response_cache_ttls or {})
+        if response_cache:
+            self.response_cache = SingleFlightCache(
+                0, max_bytes=response_cache_max_bytes)
+        self.session_pool = SessionPool(self) if session_pool else None
+
+    @property
+    def is_active(self) -> bool:
+        return time.time() - self.last_request_time < ACTIVE_SECONDS
+
+    def cache_ttl(self, path: str):
+        """ return ttl if GET path can be cached, or None """
+        if not self.response_cache:
+            return None
+        for name, pattern in CACHEABLE_ENDPOINTS.items():
+            if pattern.match(path):
+                return self.response_cache_ttls.get(name)
+        return None
+
+    def invalidate(self):
+        """ called when device state may be changed """
+        self.screenshot_cache.clear()
+        if self.response_cache:
+            self.response_cache.clear()
+
+    def cache_stats(self) -> dict:
+        return {
+            "screenshot": self.screenshot_cache.stats(),
+            "response": self.response_cache.stats() if self.response_cache else None,
+        }
+
+    def _new_http_client(self) -> httpx.AsyncClient:
+        limits = httpx.Limits(max_connections=self._pool_size,
+                              max_keepalive_connections=self._pool_size,
+                              keepalive_expiry=self._pool_idle_timeout)
+        # 超时时间手动设长，避免一些耗时操作（如获取元素树）直接超时失败
+        return httpx.AsyncClient(timeout=30.0, limits=limits)
+
+    def update(self, wda_url: str, mjpeg_url: str):
+        if wda_url != self.wda_url:
+            self.wda_url = wda_url
+            self.invalidate()
+            if self.session_pool:
+                self.session_pool.clear()  # session of the old wda
+            self.mjpeg_settings.reset()
+            # pooled connections point to the old port
+            tornado.ioloop.IOLoop.current().spawn_callback(
+                self.http_client.aclose)
+            self.http_client = self._new_http_client()
+        if mjpeg_url != self.mjpeg_url:
+            self.mjpeg_url = mjpeg_url
+            self.broadcaster.close()
+            self.broadcaster = MjpegBroadcaster(MjpegReader(mjpeg_url))
+
+    def close(self):
+        if self.session_pool:
+            self.session_pool.clear()
+        self.broadcaster.close()
+        tornado.ioloop.IOLoop.current().spawn_callback(self.http_client.aclose)
+
+
+class CorsMixin:
+    def initialize(self):
+        if not self.settings.get("keep_alive", True):
+            self.set_header('Connection', 'close')
+            self.request.connection.no_keep_alive = True
+
+    def set_default_headers(self):
+        self.set_header("Access-Control-Allow-Origin", "*")
+        self.set_header("Access-Control-Allow-Headers", "x-requested-with")
+        self.set_header('Access-Control-Allow-Methods', 'POST, GET, DELETE, OPTIONS')
+
+    def options(self, *args):
+        # no body
+        self.set_status(204)
+        self.finish()
+
+
+class RouteMixin:
+    """
+    Find DeviceRoute of the request
+
+    Handlers are created with either route=DeviceRoute (listen on device port)
+    or gateway=WDAProxyGateway, when the first path argument is udid (/devices/<udid>/...)
+    """
+
+    def initialize(self, route: DeviceRoute = None, gateway=None):
+        super().initialize()
+        self._route = route
+        self._gateway = gateway
+
+    def prepare(self):
+        if self._gateway:
+            self._route = self._gateway.get(self.path_args[0])
+            if not self._route:
+                raise tornado.web.HTTPError(404, "device not found")
+        active = self._route.is_active
+        self._route.last_request_time = time.time()
+        if not active and self._route.on_active:
+            self._route.on_active()
+
+
+class ScreenWSHandler(RouteMixin, CorsMixin, WebSocketHandler):
+    """
+    MJPEG frames as binary messages
+
+    Viewer can send control messages like {"fps": 5, "scale": 50, "quality": 20},
+    see MjpegSettings for how they are applied. Invalid ones are answered by {"error": "..."}
+    """
+
+    def check_origin(self, origin):
+        return True
+
+    def open(self, *args):
+        # print("connection created")
+        self._broadcaster = self._route.broadcaster
+        self._settings = self._route.mjpeg_settings
+        self._queue = self._broadcaster.subscribe()
+        tornado.ioloop.IOLoop.current().spawn_callback(self._write_frames,
+                                                       self._queue)
+
+    async def _write_frames(self, queue: Queue):
+        next_time = 0.0  # when the next frame is due if frames are dropped
+        while True:
+            content = await queue.get()
+            if content is None:
+                break
+            fps = self._settings.drop_fps(self)
+            if fps:
+                now = tornado.ioloop.IOLoop.current().time()
+                interval = 1.0 / fps
+                if now < next_time - interval * .1:
+                    continue
+                next_time = (next_time if next_time > now - interval else now) + interval
+            try:
+                await self.write_message(content, binary=True)
+            except WebSocketClosedError:
+                return
+        self.close()  # upstream closed
+
+    def on_message(self, message):
+        try:
+            options = parse_screen_options(message)
+        except (ValueError, TypeError) as e:
+            self.write_message({"error": str(e)})
+            return
+        self._settings.set(self, options)
+
+    def on_close(self):
+        self._settings.remove(self)
+        self._broadcaster.unsubscribe(self._queue)
+        put_latest(self._queue, None)
+        return super().on_close()
+
+
+# Ref: https://github.com/colevscode/quickproxy/blob/master/quickproxy/proxy.py
+@tornado.web.stream_request_body
+class ReverseProxyHandler(RouteMixin, CorsMixin, tornado.web.RequestHandler):
+    """
+    Request body is streamed to WDA while it is being received,
+    the upstream request starts in prepare() when there is a body.
+
+    POST /session is buffered instead, without capabilities it is answered
+    by the session pool when there is one.
+    """
+
+    def prepare(self):
+        self._body = None
+        self._upstream = None
+        self._session_body = None  # POST /session body, None: not buffered
+        super().prepare()
+        if self.request.method == "POST" and self._route.session_pool and \
+                SESSION_PATH_RE.match(self.upstream_path()):
+            self._session_body = bytearray()
+        headers = self.request.headers
+        if "Content-Length" in headers or "Transfer-Encoding" in headers:
+            self._body = Queue()
+            if self._session_body is None:
+                self._upstream = gen.convert_yielded(
+                    self.handle_request(self.request))
+
+    def data_received(self, chunk: bytes):
+        if self._body:
+            self._body.put_nowait(chunk)
+        if self._session_body is not None:
+            self._session_body.extend(chunk)
+
+    def on_connection_close(self):
+        if self._body:
+            self._body.put_nowait(None)
+
+    async def _aiter_body(self):
+        while True:
+            chunk = await self._body.get()
+            if chunk is None:
+                return
+            yield chunk
+
+    def upstream_uri(self) -> str:
+        """ request uri without /devices/<udid> prefix """
+        if not self._gateway:
+            return self.request.uri
+        uri = self.path_args[1] or "/"
+        if self.request.query:
+            uri += "?" + self.request.query
+        return uri
+
+    def upstream_path(self) -> str:
+        return self.upstream_uri().split("?", 1)[0]
+
+    def upstream_headers(self) -> list:
+        return [(k, v) for k, v in self.request.headers.get_all()
+                if k.lower() not in HOP_BY_HOP_HEADERS and k.lower() != "host"]
+
+    def copy_headers(self, headers: list):
+        """ replace default headers (eg: Content-Type), keep repeated ones (eg: Set-Cookie) """
+        copied = set()
+        for k, v in headers:
+            if k.lower() in HOP_BY_HOP_HEADERS:
+                continue
+            if k.lower() in copied:
+                self.add_header(k, v)
+            else:
+                self.set_header(k, v)
+                copied.add(k.lower())
+
+    def write_response(self, resp: UpstreamResponse):
+        self.set_status(resp.status, resp.reason)
+        self.copy_headers(resp.headers)
+        self.write(resp.body)
+
+    def proxy_error(self, url: str, e: Exception):
+        logger.warning("%s proxy %s error: %s", self._route.udid, url, e)
+        return tornado.web.HTTPError(502, str(e))
+
+    async def fetch_buffered(self, url: str) -> UpstreamResponse:
+        async with self._route.http_client.stream(
+                "GET", url, headers=self.upstream_headers()) as resp:
+            body = b"".join([chunk async for chunk in resp.aiter_raw()])
+            return UpstreamResponse(resp.status_code, resp.reason_phrase,
+                                    resp.headers.multi_items(), body)
+
+    async def handle_screenshot(self, url: str, path: str):
+        route = self._route
+        if route.screenshot_from_mjpeg:
+            frame = route.broadcaster.latest_frame()
+            if frame:
+                self.set_header("Content-Type", "application/json")
+                self.write(json.dumps({
+                    "value": base64.b64encode(frame).decode('ascii'),
+                    "sessionId": None,
+                }))
+                return
+        try:
+            resp = await route.screenshot_cache.get(
+                path, lambda: self.fetch_buffered(url))
+        except httpx.HTTPError as e:
+            raise self.proxy_error(url, e)
+        self.write_response(resp)
+
+    async def handle_cached(self, url: str, uri: str, ttl: float):
+        try:
+            resp = await self._route.response_cache.get(
+                ("GET", uri), lambda: self.fetch_buffered(url), ttl)
+        except httpx.HTTPError as e:
+            raise self.proxy_error(url, e)
+        self.write_response(resp)
+
+    async def handle_request(self, request):
+        uri = self.upstream_uri()
+        url = self._route.wda_url.rstrip("/") + uri
+        path = self.upstream_path()
+        if request.method == "GET":
+            if SCREENSHOT_PATH_RE.match(path):
+                await self.handle_screenshot(url, path)
+                return
+            ttl = self._route.cache_ttl(path)
+            if ttl:
+                await self.handle_cached(url, uri, ttl)
+                return
+        else:
+            self._route.invalidate()  # tap, type, launch may change the screen
+
+        content = self._aiter_body() if self._body else None
+        try:
+            async with self._route.http_client.stream(
+                    request.method,
+                    url,
+                    headers=self.upstream_headers(),
+                    content=content) as resp:
+                self.set_status(resp.status_code, resp.reason_phrase)
+                self.copy_headers(resp.headers.multi_items())
+                async for chunk in resp.aiter_raw():
+                    self.write(chunk)
+        except httpx.HTTPError as e:
+            raise self.proxy_error(url, e)
+        finally:
+            if request.method != "GET":
+                # GETs during the mutation may have cached the old state
+                self._route.invalidate()
+
+    async def handle_pooled_session(self) -> bool:
+        """ return True if answered by a pre-created session """
+        pool = self._route.session_pool
+        if is_default_session_request(bytes(self._session_body)):
+            resp = await pool.take()
+            if resp:
+                self.write_response(resp)
+                return True
+        await pool.hold()
+        return False
+
+    async def proxy(self):
+        if self._body:
+            self._body.put_nowait(None)  # whole body received
+        if self._session_body is not None and await self.handle_pooled_session():
+            return
+        if self._upstream:
+            await self._upstream
+        else:
+            await self.handle_request(self.request)
+        pool = self._route.session_pool
+        if pool and self.request.method == "DELETE" and \
+                SESSION_ID_PATH_RE.match(self.upstream_path()):
+            pool.release()
+
+    async def get(self, *args):
+        await self.proxy()
+
+    async def post(self, *args):
+        await self.proxy()
+
+    async def delete(self, *args):
+        await self.proxy()
+
+
+class CacheStatsHandler(RouteMixin, CorsMixin, tornado.web.RequestHandler):
+    """ hit/miss counters of proxy caches """
+
+    def get(self, *args):
+        self.write(self._route.cache_stats())
+
+
+class SessionPoolHandler(RouteMixin, CorsMixin, tornado.web.RequestHandler):
+    """
+    GET: session pool counters
+    POST: take a pre-created session, same response as WDA POST /session
+    """
+
+    def prepare(self):
+        super().prepare()
+        if not self._route.session_pool:
+            raise tornado.web.HTTPError(404, "session pool disabled")
+
+    def get(self, *args):
+        self.write(self._route.session_pool.stats())
+
+    async def post(self, *args):
+        resp = await self._route.session_pool.take()
+        if not resp:
+            raise tornado.web.HTTPError(503, "no pre-created session")
+        self.set_status(resp.status, resp.reason)
+        for k, v in resp.headers:
+            self.set_header(k, v)
+        self.write(resp.body)
+
+
+def make_app(route: DeviceRoute, **settings):
+    """ app of one device """
+    return tornado.web.Application([
+        (r"/screen", ScreenWSHandler, dict(route=route)),
+        (r"/wdaproxy/cache", CacheStatsHandler, dict(route=route)),
+        (r"/wdaproxy/session", SessionPoolHandler, dict(route=route)),
+        (r"/.*", ReverseProxyHandler, dict(route=route)),
+    ], **settings)
+
+
+class WDAProxyGateway(object):
+    """
+    Serve WDA reverse proxy and /screen of all devices in current process
+
+    Each device is reachable by its own listening port, and by the /devices/<udid>/...
+    prefix with handlers(). Changing the public port only replaces the listener.
+    A standby listener can be opened in advance, swap() makes it the public one.
+
+    Example usage:
+
+    gateway = WDAProxyGateway()
+    gateway.route("xxxx-udid", 20003, "http://localhost:20001", "http://localhost:20002")
+    gateway.standby("xxxx-udid", 20004)
+    gateway.swap("xxxx-udid") # 20004 is public, 20003 closed
+    gateway.remove("xxxx-udid")
+    """
+
+    def __init__(self, **route_options):
+        """
+        Args:
+            route_options: keyword arguments of DeviceRoute, eg: pool_size, screenshot_ttl
+        """
+        self._routes = {}  # udid -> DeviceRoute
+        self._servers = {}  # udid -> (port, HTTPServer)
+        self._standby_servers = {}  # udid -> (port, HTTPServer), not published yet
+        self._route_options = route_options
+
+    def get(self, udid: str) -> DeviceRoute:
+        return self._routes.get(udid)
+
+    def handlers(self) -> list:
+        """ handlers to be added to an Application for /devices/<udid>/... routing """
+        kwargs = dict(gateway=self)
+        return [
+            (r"/devices/([^/]+)/screen", ScreenWSHandler, kwargs),
+            (r"/devices/([^/]+)/wdaproxy/cache", CacheStatsHandler, kwargs),
+            (r"/devices/([^/]+)/wdaproxy/session", SessionPoolHandler, kwargs),
+            (r"/devices/([^/]+)(/.*)?", ReverseProxyHandler, kwargs),
+        ]
+
+    def route(self, udid: str, port: int, wda_url: str, mjpeg_url: str):
+        """ add or update device route, listen on port if it changed """
+        r = self._routes.get(udid)
+        if r:
+            r.update(wda_url, mjpeg_url)
+        else:
+            r = self._routes[udid] = DeviceRoute(udid, wda_url, mjpeg_url,
+                                                 **self._route_options)
+
+        old_port, _ = self._servers.get(udid, (None, None))
+        if old_port == port:
+            return
+        self._stop_server(self._servers, udid)
+        self._servers[udid] = (port, self._listen(r, port))
+        logger.debug("wdaproxy gateway %s listen on port %d", udid, port)
+
+    def standby(self, udid: str, port: int):
+        """ listen on port for route of udid, until swap() or remove() called """
+        self._stop_server(self._standby_servers, udid)
+        self._standby_servers[udid] = (port, self._listen(self._routes[udid], port))
+
+    def swap(self, udid: str) -> int:
+        """
+        standby listener becomes the public one, previous public listener is closed
+
+        Returns:
+            new public port
+
+        Raises:
+            KeyError: no standby listener
+        """
+        standby = self._standby_servers.pop(udid)
+        self._stop_server(self._servers, udid)
+        self._servers[udid] = standby
+        logger.debug("wdaproxy gateway %s swapped to port %d", udid, standby[0])
+        return standby[0]
+
+    def remove(self, udid: str):
+        self._stop_server(self._servers, udid)
+        self._stop_server(self._standby_servers, udid)
+        r = self._routes.pop(udid, None)
+        if r:
+            r.close()
+
+    def _listen(self, route: DeviceRoute, port: int) -> HTTPServer:
+        server = HTTPServer(make_app(route))
+        server.listen(port)
+        return server
+
+    def _stop_server(self, servers: dict, udid: str):
+        _, server = servers.pop(udid, (None, None))
+        if server:
+            server.stop()
+            tornado.ioloop.IOLoop.current().spawn_callback(
+                server.close_all_connections)